@@ -0,0 +1,52 @@
+from pygame import Surface, surfarray
+import numpy as np
+
+'''Bulk drawing straight into a surface's pixel array, for drawing thousands of
+particles and bonds without one draw call each.'''
+
+def _plot(screen: Surface, xs: np.ndarray, ys: np.ndarray, color):
+    '''Sets the pixels at the given integer coordinates, skipping those off the surface.'''
+    width, height = screen.get_size()
+    on_screen = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    pixels = surfarray.pixels2d(screen)
+    pixels[xs[on_screen], ys[on_screen]] = screen.map_rgb(color)
+    del pixels # Unlock the surface
+
+def _discOffsets(radius: int) -> tuple[np.ndarray, np.ndarray]:
+    r = int(radius)
+    dx, dy = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1), indexing='ij')
+    inside = dx**2 + dy**2 <= r**2
+    return (dx[inside], dy[inside])
+
+def drawDots(screen: Surface, positions: np.ndarray, color, radius: int):
+    '''Draws a filled disc of the given radius at each of an N×2 array of positions.'''
+    if len(positions) == 0:
+        return
+    offset_x, offset_y = _discOffsets(radius)
+    centers = np.floor(positions).astype(np.int64)
+    _plot(screen, (centers[:, 0, None] + offset_x).ravel(), (centers[:, 1, None] + offset_y).ravel(), color)
+
+def drawSegments(screen: Surface, starts: np.ndarray, ends: np.ndarray, color, thickness: int):
+    '''Draws a line of the given thickness from each start to its end (both N×2 arrays).
+    Every segment is sampled once per pixel along its longer axis and widened across
+    that axis. Segments are sampled together in groups of the same pixel length.'''
+    if len(starts) == 0:
+        return
+    deltas = ends - starts
+    steps = np.ceil(np.abs(deltas).max(axis=1)).astype(np.int64) + 1
+    width_offsets = np.arange(thickness) - thickness // 2
+
+    xs, ys = [], []
+    for step_count in np.unique(steps):
+        group = steps == step_count
+        t = np.linspace(0, 1, step_count)
+        start_x, start_y = starts[group, 0], starts[group, 1]
+        delta_x, delta_y = deltas[group, 0], deltas[group, 1]
+        points_x = np.floor(start_x[:, None] + np.multiply.outer(delta_x, t)).astype(np.int32)
+        points_y = np.floor(start_y[:, None] + np.multiply.outer(delta_y, t)).astype(np.int32)
+        # Widen vertically for mostly horizontal lines and horizontally otherwise
+        horizontal = (np.abs(delta_x) >= np.abs(delta_y))[:, None]
+        for offset in width_offsets:
+            xs.append((points_x + np.where(horizontal, 0, offset)).ravel())
+            ys.append((points_y + np.where(horizontal, offset, 0)).ravel())
+    _plot(screen, np.concatenate(xs), np.concatenate(ys), color)
@@ -0,0 +1,402 @@
+'''Performance benchmarks.
+
+    python benchmark.py suite --output bench.json     Time every build, physics and render phase
+    python benchmark.py compare old.json new.json     Compare two suite runs
+    python benchmark.py collisions                    Spatial hash against all-pairs collisions
+    python benchmark.py scaling --workers 16          Parallel step on 1 to 16 worker processes
+    python benchmark.py solvers                       Force based springs against XPBD
+    python benchmark.py statics                       Staticbody polygons against a distance field
+    python benchmark.py sleep                         Islands falling asleep as a scene settles
+'''
+import os
+# Must be set before pygame is initialised
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from time import perf_counter
+import json
+import platform
+import subprocess
+import numpy as np
+import pygame
+from pygame import Surface, draw
+from drawing import BrushColors, floodFill
+from main import Simulation, SimulationState
+from particle_array import ParticleArray
+from simulation_builder import buildSoftbodies, buildStaticbodies, bodyMask, simplifyShapes, vertexCount
+from contours import traceContours
+from build_cache import sceneKey
+from world import World
+from xpbd import XPBDSolver
+from distance_field import DistanceField
+
+def _randomStore(count, density, seed=0) -> ParticleArray:
+    '''Particles scattered uniformly over a square sized for the given number of
+    particles per contact-radius-sized cell.'''
+    rng = np.random.default_rng(seed)
+    side = ParticleArray.CONTACT_RADIUS * np.sqrt(count / density)
+    store = ParticleArray(count)
+    store.addMany(rng.uniform(0, side, (count, 2)), rng.normal(0, 20, (count, 2)), 1)
+    return store
+
+def _time(setup, function, repeats) -> list[float]:
+    '''Wall times of function(setup()) over the given number of repeats. Only the
+    function call is timed.'''
+    times = []
+    for _ in range(repeats):
+        subject = setup()
+        start_time = perf_counter()
+        function(subject)
+        times.append(perf_counter() - start_time)
+    return times
+
+def _bruteForceCollisions(store: ParticleArray):
+    for index in range(store.count):
+        store.pushNeighbours(index)
+
+def benchmarkCollisions(counts=(250, 500, 1000, 2000, 4000, 8000), densities=(0.05, 0.3), repeats=3,
+                        brute_force_limit=4000):
+    '''Times one collision pass with the spatial hash against the all-pairs pass and
+    checks that both give the same positions and velocities.'''
+    print(f'{"density":>8} {"particles":>10} {"hash (ms)":>10} {"brute (ms)":>11} {"match":>6}')
+    for density, count in [(density, count) for density in densities for count in counts]:
+        setup = lambda: _randomStore(count, density)
+        hash_time = min(_time(setup, ParticleArray.resolveCollisions, repeats))
+        hashed = setup()
+        hashed.resolveCollisions()
+
+        brute_time, match = float('nan'), ''
+        if count <= brute_force_limit:
+            brute_time = min(_time(setup, _bruteForceCollisions, 1))
+            brute = setup()
+            _bruteForceCollisions(brute)
+            match = np.allclose(hashed.pos[:count], brute.pos[:count]) and np.allclose(hashed.vel[:count], brute.vel[:count])
+
+        print(f'{density:>8} {count:>10} {1000*hash_time:>10.2f} {1000*brute_time:>11.2f} {str(match):>6}')
+
+
+'''Synthetic canvases. Every shape is placed relative to the canvas size so that a
+scene looks the same at every resolution.'''
+
+def _blankCanvas(resolution) -> Surface:
+    canvas = Surface(resolution)
+    canvas.fill(BrushColors.erase)
+    return canvas
+
+def _floor(canvas: Surface):
+    width, height = canvas.get_size()
+    draw.rect(canvas, BrushColors.staticbody, (0, int(0.85*height), width, height))
+
+def singleBlobCanvas(resolution) -> Surface:
+    canvas = _blankCanvas(resolution)
+    width, height = resolution
+    draw.circle(canvas, BrushColors.softbody, (width // 2, height // 3), int(0.2*min(width, height)))
+    _floor(canvas)
+    return canvas
+
+def manyBlobsCanvas(resolution, count=40, seed=0) -> Surface:
+    canvas = _blankCanvas(resolution)
+    width, height = resolution
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        center = (int(rng.uniform(0.05, 0.95)*width), int(rng.uniform(0.05, 0.7)*height))
+        draw.circle(canvas, BrushColors.softbody, center, int(rng.uniform(0.02, 0.06)*min(width, height)))
+    _floor(canvas)
+    return canvas
+
+def terrainCanvas(resolution, seed=0) -> Surface:
+    '''Rolling hills over the lower half with caves cut into them, and a small blob.'''
+    canvas = _blankCanvas(resolution)
+    width, height = resolution
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(0, width, 200)
+    phases = rng.uniform(0, 2*np.pi, 3)
+    ys = height * (0.55 + 0.08*np.sin(xs/width*6 + phases[0]) + 0.04*np.sin(xs/width*17 + phases[1])
+                   + 0.02*np.sin(xs/width*41 + phases[2]))
+    hills = [(0, height)] + list(zip(xs.tolist(), ys.tolist())) + [(width, height)]
+    draw.polygon(canvas, BrushColors.staticbody, hills)
+    for _ in range(12):
+        center = (int(rng.uniform(0.05, 0.95)*width), int(rng.uniform(0.72, 0.95)*height))
+        draw.circle(canvas, BrushColors.erase, center, int(rng.uniform(0.01, 0.04)*min(width, height)))
+    draw.circle(canvas, BrushColors.softbody, (width // 2, height // 5), int(0.06*min(width, height)))
+    return canvas
+
+def denseFillCanvas(resolution) -> Surface:
+    '''Softbody over everything above the floor.'''
+    canvas = _blankCanvas(resolution)
+    width, height = resolution
+    draw.rect(canvas, BrushColors.softbody, (0, 0, width, int(0.8*height)))
+    _floor(canvas)
+    return canvas
+
+SCENES = {
+    'single_blob': singleBlobCanvas,
+    'many_blobs': manyBlobsCanvas,
+    'terrain': terrainCanvas,
+    'dense_fill': denseFillCanvas,
+}
+RESOLUTIONS = [(400, 300), (800, 600), (1600, 1200)]
+VOXEL_SIZES = [6, 12]
+
+
+def _stats(times) -> dict:
+    times = np.array(times)
+    return {'mean': float(times.mean()), 'median': float(np.median(times)), 'min': float(times.min()),
+            'p95': float(np.percentile(times, 95)), 'repeats': len(times)}
+
+def _buildState(canvas, voxel_size) -> SimulationState:
+    return SimulationState.fromCanvas(canvas, BrushColors.softbody, BrushColors.staticbody,
+                                      Simulation.EDGE_TOLERANCE, voxel_size,
+                                      Simulation.PARTICLE_MASS, Simulation.SPRING_K)
+
+def benchmarkScene(canvas: Surface, voxel_size: int, repeats=5, steps=50, warmup_steps=10) -> dict:
+    '''Times each build, physics and render phase of one canvas separately.'''
+    timings = {}
+
+    timings['buildSoftbodies'] = _stats(_time(lambda: canvas, lambda canvas: buildSoftbodies(
+        canvas, BrushColors.softbody, voxel_size, Simulation.PARTICLE_MASS, Simulation.SPRING_K, World()), repeats))
+    timings['buildStaticbodies'] = _stats(_time(lambda: canvas, lambda canvas: buildStaticbodies(
+        canvas, BrushColors.staticbody, Simulation.EDGE_TOLERANCE, World()), repeats))
+    timings['sceneKey'] = _stats(_time(lambda: canvas, lambda canvas: sceneKey(
+        canvas, BrushColors.softbody, BrushColors.staticbody, Simulation.EDGE_TOLERANCE, voxel_size,
+        Simulation.PARTICLE_MASS, Simulation.SPRING_K), repeats))
+    # Fill the empty space from the top left corner
+    timings['floodFill'] = _stats(_time(canvas.copy, lambda canvas: floodFill(
+        canvas, (200, 40, 40), (0, 0)), repeats))
+
+    traced_shapes = traceContours(bodyMask(canvas, BrushColors.staticbody))
+    timings['simplifyShapes'] = _stats(_time(lambda: traced_shapes, lambda shapes: simplifyShapes(
+        shapes, Simulation.EDGE_TOLERANCE), repeats))
+
+    state = _buildState(canvas, voxel_size)
+    for _ in range(warmup_steps):
+        state.update(Simulation.PHYSICS_DT)
+    timings['SimulationState.update'] = _stats(_time(lambda: state, lambda state: state.update(Simulation.PHYSICS_DT), steps))
+    screen = Surface(canvas.get_size())
+    timings['SimulationState.render'] = _stats(_time(lambda: screen, state.render, repeats))
+
+    return {
+        'particles': len(state.particle_indices),
+        'spring_bonds': state.springs.count,
+        'staticbodies': len(state.staticbodies),
+        'static_edges': sum(len(staticbody.shape.edge_ends) for staticbody in state.staticbodies),
+        # Staticbody outline points before and after simplification
+        'static_vertices_traced': vertexCount(traced_shapes),
+        'static_vertices': vertexCount(simplifyShapes(traced_shapes, Simulation.EDGE_TOLERANCE)),
+        'timings': timings,
+    }
+
+def benchmarkScaling(scene='dense_fill', resolution=(1600, 1200), voxel_size=6, max_workers=os.cpu_count(),
+                     steps=20, warmup_steps=2):
+    '''Times SimulationState.update on the main process and on 1 to max_workers
+    worker processes.'''
+    worker_counts = [0] + sorted({2**power for power in range(max_workers.bit_length())} | {max_workers})
+    canvas = SCENES[scene](resolution)
+    print(f'{scene} {resolution[0]}x{resolution[1]} voxel {voxel_size}')
+    print(f'{"workers":>8} {"step (ms)":>10} {"speedup":>8}')
+    serial_time = None
+    for workers in worker_counts:
+        state = _buildState(canvas, voxel_size)
+        state.useWorkers(workers)
+        for _ in range(warmup_steps):
+            state.update(Simulation.PHYSICS_DT)
+        step_time = np.median(_time(lambda: state, lambda state: state.update(Simulation.PHYSICS_DT), steps))
+        state.close()
+        serial_time = serial_time or step_time
+        print(f'{workers or "main":>8} {1000*step_time:>10.2f} {serial_time / step_time:>8.2f}')
+
+def _bondStrain(state: SimulationState) -> float:
+    '''Largest relative stretch or compression of any bond.'''
+    springs, pos = state.springs, state.world.particles.pos
+    lengths = np.linalg.norm(pos[springs.i2[:springs.count]] - pos[springs.i1[:springs.count]], axis=1)
+    strain = np.abs(lengths - springs.rest_length[:springs.count]) / springs.rest_length[:springs.count]
+    return float(np.nanmax(strain, initial=0)) if np.isfinite(strain).all() else float('inf')
+
+BLOWN_UP_STRAIN = 10 # Bond strain past which a run is stopped as unstable
+
+def benchmarkSolvers(scene='many_blobs', resolution=(800, 600), voxel_size=12, spring_ks=(1000, 20000),
+                     dts=(1/240, 1/60, 1/30), sim_time=2, iterations=XPBDSolver.ITERATIONS) -> list[dict]:
+    '''Runs a scene for sim_time seconds with the force based springs and with
+    XPBDSolver, at every stiffness and step. Compares the cost of a simulated second
+    and the worst bond strain seen, which stays small while a solver is stable. Runs
+    that blow up are stopped.'''
+    canvas = SCENES[scene](resolution)
+    print(f'{scene} {resolution[0]}x{resolution[1]} voxel {voxel_size}, {sim_time}s simulated')
+    print(f'{"solver":>7} {"k":>7} {"dt":>7} {"step (ms)":>10} {"sim s (ms)":>11} {"max strain":>11}')
+    results = []
+    with np.errstate(all='ignore'):
+        for solver in ('force', 'xpbd'):
+            for spring_k in spring_ks:
+                for dt in dts:
+                    state = SimulationState.fromCanvas(canvas, BrushColors.softbody, BrushColors.staticbody,
+                                                       Simulation.EDGE_TOLERANCE, voxel_size, Simulation.PARTICLE_MASS,
+                                                       spring_k)
+                    if solver == 'xpbd':
+                        state.solver = XPBDSolver(iterations)
+                    steps = round(sim_time / dt)
+                    max_strain = 0
+                    step_time = 0
+                    for step in range(1, steps + 1):
+                        start_time = perf_counter()
+                        state.update(dt)
+                        step_time += perf_counter() - start_time
+                        max_strain = max(max_strain, _bondStrain(state))
+                        if max_strain > BLOWN_UP_STRAIN:
+                            break
+                    step_time /= step
+                    results.append({'solver': solver, 'spring_k': spring_k, 'dt': dt, 'step_time': step_time,
+                                    'sim_second_time': step_time / dt, 'max_strain': max_strain})
+                    strain = f'{max_strain:.3f}' if max_strain <= BLOWN_UP_STRAIN else 'blew up'
+                    print(f'{solver:>7} {spring_k:>7} {f"1/{round(1/dt)}":>7} {1000*step_time:>10.2f} '
+                          f'{1000*step_time/dt:>11.1f} {strain:>11}')
+    return results
+
+def benchmarkSleep(scene='many_blobs', resolution=(800, 600), voxel_size=12, sim_time=16, report_every=1) -> list[dict]:
+    '''Runs a scene for sim_time seconds and reports every report_every seconds how
+    many of its islands are asleep, how many particles are still stepped and how long
+    a step took on average since the last report.'''
+    canvas = SCENES[scene](resolution)
+    state = _buildState(canvas, voxel_size)
+    islands = state.islands
+    print(f'{scene} {resolution[0]}x{resolution[1]} voxel {voxel_size}, {islands.island_count} islands')
+    print(f'{"time (s)":>9} {"asleep":>7} {"awake particles":>16} {"step (ms)":>10}')
+    steps_per_report = round(report_every / Simulation.PHYSICS_DT)
+    results = []
+    for report in range(1, round(sim_time / report_every) + 1):
+        step_time = np.mean(_time(lambda: state, lambda state: state.update(Simulation.PHYSICS_DT), steps_per_report))
+        results.append({'time': report * report_every, 'asleep': int(islands.asleep.sum()),
+                        'awake_particles': len(islands.awake_particles), 'step_time': float(step_time)})
+        print(f'{report * report_every:>9} {results[-1]["asleep"]:>7} {results[-1]["awake_particles"]:>16} '
+              f'{1000*step_time:>10.2f}')
+    return results
+
+def benchmarkStaticCollisions(resolution=(1600, 1200), count=20000, edge_tolerances=(0.5, 1.5, 4), repeats=5,
+                              seed=0) -> list[dict]:
+    '''Times one static collision pass of particles scattered over each scene, against
+    every staticbody polygon (at each edge tolerance) and against a DistanceField, and
+    how often both agree on which particles hit.'''
+    print(f'{"scene":>12} {"tolerance":>10} {"vertices":>9} {"polygons (ms)":>14} {"field (ms)":>11} '
+          f'{"field build (ms)":>17} {"agree":>6}')
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform((0, 0), resolution, (count, 2))
+    velocities = rng.normal(0, 100, (count, 2))
+    results = []
+    for name, make_canvas in SCENES.items():
+        canvas = make_canvas(resolution)
+        start_time = perf_counter()
+        field = DistanceField.fromCanvas(canvas, BrushColors.staticbody)
+        field_build_time = perf_counter() - start_time
+        field_hits = field.sample(positions)[0] < 0
+        field_time = min(_time(lambda: (positions.copy(), velocities.copy()),
+                               lambda arrays: field.collide(*arrays, Simulation.PHYSICS_DT), repeats))
+        for edge_tolerance in edge_tolerances:
+            staticbodies = buildStaticbodies(canvas, BrushColors.staticbody, edge_tolerance, World())
+            polygon_hits = np.zeros(count, dtype=bool)
+            for staticbody in staticbodies:
+                polygon_hits |= staticbody.shape.containsPoints(positions)
+            collide = lambda arrays: [staticbody.collide(*arrays, Simulation.PHYSICS_DT) for staticbody in staticbodies]
+            polygon_time = min(_time(lambda: (positions.copy(), velocities.copy()), collide, repeats))
+            vertices = sum(len(staticbody.shape.edge_ends) for staticbody in staticbodies)
+            agree = float(np.mean(polygon_hits == field_hits))
+            results.append({'scene': name, 'edge_tolerance': edge_tolerance, 'static_vertices': vertices,
+                            'polygon_time': polygon_time, 'field_time': field_time,
+                            'field_build_time': field_build_time, 'agree': agree})
+            print(f'{name:>12} {edge_tolerance:>10} {vertices:>9} {1000*polygon_time:>14.2f} {1000*field_time:>11.2f} '
+                  f'{1000*field_build_time:>17.1f} {agree:>6.3f}')
+    return results
+
+def _gitCommit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def benchmarkSuite(scenes=SCENES, resolutions=RESOLUTIONS, voxel_sizes=VOXEL_SIZES, repeats=5, steps=50) -> dict:
+    results = []
+    for name, make_canvas in scenes.items():
+        for resolution in resolutions:
+            canvas = make_canvas(resolution)
+            for voxel_size in voxel_sizes:
+                result = {'scene': name, 'resolution': list(resolution), 'voxel_size': voxel_size}
+                result.update(benchmarkScene(canvas, voxel_size, repeats, steps))
+                results.append(result)
+                phases = '  '.join(f'{phase} {1000*timing["median"]:.2f}ms'
+                                   for phase, timing in result['timings'].items())
+                print(f'{name} {resolution[0]}x{resolution[1]} voxel {voxel_size} '
+                      f'({result["particles"]} particles, {result["static_vertices_traced"]} -> '
+                      f'{result["static_vertices"]} static vertices): {phases}')
+    return {
+        'meta': {
+            'commit': _gitCommit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pygame': pygame.version.ver,
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+
+def compareSuites(old: dict, new: dict):
+    '''Prints the change in median time of every phase that appears in both runs.'''
+    key = lambda result: (result['scene'], tuple(result['resolution']), result['voxel_size'])
+    old_results = {key(result): result for result in old['results']}
+    print(f'old {old["meta"]["commit"][:10]}  new {new["meta"]["commit"][:10]}')
+    for result in new['results']:
+        if key(result) not in old_results:
+            continue
+        old_timings = old_results[key(result)]['timings']
+        for phase, timing in result['timings'].items():
+            if phase not in old_timings:
+                continue
+            old_median, new_median = old_timings[phase]['median'], timing['median']
+            print(f'{result["scene"]:>12} {result["resolution"][0]:>5}x{result["resolution"][1]:<5} '
+                  f'voxel {result["voxel_size"]:>3} {phase:>24} {1000*old_median:>9.2f}ms -> '
+                  f'{1000*new_median:>9.2f}ms  x{new_median / old_median:.2f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Softbody performance benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    suite = commands.add_parser('suite', help='time every build, physics and render phase')
+    suite.add_argument('--output', default='bench_output.json')
+    suite.add_argument('--quick', action='store_true', help='only the two smaller resolutions, fewer repeats')
+    compare = commands.add_parser('compare', help='compare two suite results')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    commands.add_parser('collisions', help='spatial hash against all-pairs collisions')
+    scaling = commands.add_parser('scaling', help='parallel step on 1 to N worker processes')
+    scaling.add_argument('--workers', type=int, default=os.cpu_count())
+    scaling.add_argument('--scene', choices=SCENES, default='dense_fill')
+    solvers = commands.add_parser('solvers', help='force based springs against XPBD, for cost and stability')
+    solvers.add_argument('--scene', choices=SCENES, default='many_blobs')
+    solvers.add_argument('--iterations', type=int, default=XPBDSolver.ITERATIONS)
+    commands.add_parser('statics', help='staticbody polygons against a distance field')
+    sleep = commands.add_parser('sleep', help='islands falling asleep as a scene settles')
+    sleep.add_argument('--scene', choices=SCENES, default='many_blobs')
+    sleep.add_argument('--time', type=float, default=16, help='simulated seconds')
+    args = parser.parse_args()
+
+    match args.command:
+        case 'suite':
+            if args.quick:
+                report = benchmarkSuite(resolutions=RESOLUTIONS[:2], repeats=2, steps=10)
+            else:
+                report = benchmarkSuite()
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=1)
+        case 'compare':
+            with open(args.old) as old_file, open(args.new) as new_file:
+                compareSuites(json.load(old_file), json.load(new_file))
+        case 'collisions':
+            benchmarkCollisions()
+        case 'scaling':
+            benchmarkScaling(args.scene, max_workers=args.workers)
+        case 'solvers':
+            benchmarkSolvers(args.scene, iterations=args.iterations)
+        case 'statics':
+            benchmarkStaticCollisions()
+        case 'sleep':
+            benchmarkSleep(args.scene, sim_time=args.time)
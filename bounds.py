@@ -1,4 +1,5 @@
 from pygame import Vector3
+import numpy as np
 
 class Boundary:
 
@@ -32,12 +33,31 @@ class CircularBound(Boundary):
 
 class PolygonalBound(Boundary):
 
-    def __init__(self, points: list[tuple]):
+    # Maximum number of point-edge pairs tested at once by the batch queries
+    BATCH_SIZE = 1 << 18
+
+    def __init__(self, points: list[tuple], holes: list[list[tuple]] = None):
         self.points = points
+        self.holes = holes if holes is not None else []
+        # The outer loop followed by the loops of any holes
+        self.rings = [self.points] + self.holes
 
         # Calculate rectangle boundary for collision optimization
         self.rectangle_bound = PolygonalBound.getRectangularBounds(self)
 
+        # Edge i of a ring runs from point i-1 to point i, matching the scalar queries.
+        # Edges of all rings are stored one ring after another.
+        self.edge_ends = np.concatenate([np.array(ring, dtype=float).reshape(-1, 2) for ring in self.rings])
+        self.edge_starts = np.concatenate([np.roll(np.array(ring, dtype=float).reshape(-1, 2), 1, axis=0)
+                                           for ring in self.rings])
+        # Unit normals are the edge vectors (start - end) rotated by 90 degrees
+        edge_vecs = self.edge_starts - self.edge_ends
+        self._edge_squared_lengths = np.einsum('ij,ij->i', edge_vecs, edge_vecs)
+        self.edge_normals = np.zeros_like(edge_vecs)
+        nonzero = self._edge_squared_lengths != 0
+        self.edge_normals[nonzero] = (np.stack((-edge_vecs[:, 1], edge_vecs[:, 0]), axis=1)[nonzero]
+                                      / np.sqrt(self._edge_squared_lengths[nonzero, None]))
+
     @staticmethod
     def getRectangularBounds(polygonal_bounds) -> RectangularBound:
         points = polygonal_bounds.points
@@ -57,15 +77,18 @@ class PolygonalBound(Boundary):
         height = max_y - min_y
 
         return RectangularBound(min_x, min_y, width, height)
+
+    def edges(self):
+        '''Yields the (start, end) point pair of every edge of every ring.'''
+        for ring in self.rings:
+            for i in range(len(ring)):
+                yield (ring[i - 1], ring[i])
     
     def getClosestEdgeToPoint(self, point: tuple) -> list[tuple]:
         '''Gets the pair of points representing the polygon's closest 
         edge the given point.'''
         edge_distances = []
-        for i in range(len(self.points)):
-            p1 = self.points[i - 1]
-            p2 = self.points[i]
-            
+        for p1, p2 in self.edges():
             AC = Vector3(point[0] - p1[0], point[1] - p1[1], 0)
             AB = Vector3(p2[0] - p1[0], p2[1] - p1[1], 0)
 
@@ -81,10 +104,7 @@ class PolygonalBound(Boundary):
             return False
         # "Raytrace" downwards from point
         num_intersections = 0
-        for i in range(len(self.points)):
-            p1 = self.points[i - 1]
-            p2 = self.points[i]
-
+        for p1, p2 in self.edges():
             # Sort the points horizontally
             sorted_points = [p1, p2]
             sorted_points.sort(key=lambda p: p[0])
@@ -105,4 +125,99 @@ class PolygonalBound(Boundary):
         
         return num_intersections % 2 == 1
 
+    def _batches(self, count):
+        batch_size = max(1, PolygonalBound.BATCH_SIZE // len(self.edge_ends))
+        for start in range(0, count, batch_size):
+            yield slice(start, min(count, start + batch_size))
+
+    def rectangleContainsPoints(self, points: np.ndarray) -> np.ndarray:
+        rect = self.rectangle_bound
+        return ((points[:, 0] >= rect.x) & (points[:, 0] <= rect.x + rect.width) &
+                (points[:, 1] >= rect.y) & (points[:, 1] <= rect.y + rect.height))
+
+    def containsPoints(self, points: np.ndarray) -> np.ndarray:
+        '''Batch version of contains for an N×2 array of points. Returns a boolean mask.'''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        mask = self.rectangleContainsPoints(points)
+        candidates = np.flatnonzero(mask)
+
+        # Sort every edge horizontally and drop vertical ones
+        left = np.where(self.edge_starts[:, :1] <= self.edge_ends[:, :1], self.edge_starts, self.edge_ends)
+        right = np.where(self.edge_starts[:, :1] <= self.edge_ends[:, :1], self.edge_ends, self.edge_starts)
+        sloped = right[:, 0] - left[:, 0] != 0
+        left, right = left[sloped], right[sloped]
+        m = (right[:, 1] - left[:, 1]) / (right[:, 0] - left[:, 0])
+        b = left[:, 1] - m*left[:, 0]
+
+        for batch in self._batches(len(candidates)):
+            px = points[candidates[batch], 0, None]
+            py = points[candidates[batch], 1, None]
+            # "Raytrace" downwards, counting edges under the point that intersect below it
+            crossings = (px >= left[:, 0]) & (px <= right[:, 0]) & (m*px + b >= py)
+            mask[candidates[batch]] = np.count_nonzero(crossings, axis=1) % 2 == 1
+        return mask
+
+    def getClosestEdges(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''Batch version of getClosestEdgeToPoint for an N×2 array of points. Returns the
+        index of each point's closest edge (see edge_starts/edge_ends) and its normal.'''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        edge_vecs = self.edge_ends - self.edge_starts
+        degenerate = self._edge_squared_lengths == 0
+        inverse_lengths = 1 / np.where(degenerate, 1, self._edge_squared_lengths)
+        edge_indices = np.zeros(len(points), dtype=np.int64)
+        for batch in self._batches(len(points)):
+            offsets_x = points[batch, 0, None] - self.edge_starts[:, 0]
+            offsets_y = points[batch, 1, None] - self.edge_starts[:, 1]
+            # Squared distance from each point to each edge's line
+            cross = offsets_x*edge_vecs[:, 1] - offsets_y*edge_vecs[:, 0]
+            edge_indices[batch] = np.argmin(np.where(degenerate, np.inf, cross*cross * inverse_lengths), axis=1)
+        return (edge_indices, self.edge_normals[edge_indices])
+
+    def sweepPoints(self, starts: np.ndarray, ends: np.ndarray,
+                    outward_normals: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Finds where points moving in straight lines from starts to ends (N×2 arrays)
+        first cross into the polygon, through an edge against its outward normal (an
+        E×2 array, one per edge). Returns a mask of the points that cross, the fraction
+        of the way along its line that each crosses and the edge it crosses through
+        (1 and -1 for the others).'''
+        starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+        moves = np.asarray(ends, dtype=float).reshape(-1, 2) - starts
+        fractions = np.ones(len(starts))
+        edge_indices = np.full(len(starts), -1, dtype=np.int64)
+        # Only lines whose bounding box overlaps the polygon's can cross it
+        rect = self.rectangle_bound
+        low, high = np.minimum(starts, starts + moves), np.maximum(starts, starts + moves)
+        candidates = np.flatnonzero((high[:, 0] >= rect.x) & (low[:, 0] <= rect.x + rect.width) &
+                                    (high[:, 1] >= rect.y) & (low[:, 1] <= rect.y + rect.height))
+
+        edge_vecs = self.edge_ends - self.edge_starts
+        for batch in self._batches(len(candidates)):
+            points = candidates[batch]
+            move_x, move_y = moves[points, 0, None], moves[points, 1, None]
+            offsets_x = self.edge_starts[:, 0] - starts[points, 0, None]
+            offsets_y = self.edge_starts[:, 1] - starts[points, 1, None]
+            # Where start + t × move = edge start + u × edge vector. Parallel lines never meet.
+            denominators = move_x*edge_vecs[:, 1] - move_y*edge_vecs[:, 0]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (offsets_x*edge_vecs[:, 1] - offsets_y*edge_vecs[:, 0]) / denominators
+                u = (offsets_x*move_y - offsets_y*move_x) / denominators
+            inward = move_x*outward_normals[:, 0] + move_y*outward_normals[:, 1] < 0
+            t = np.where(inward & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1), t, np.inf)
+            first = np.argmin(t, axis=1)
+            first_t = t[np.arange(len(points)), first]
+            crossed = np.isfinite(first_t)
+            fractions[points[crossed]] = first_t[crossed]
+            edge_indices[points[crossed]] = first[crossed]
+        return (edge_indices != -1, fractions, edge_indices)
+
+    def queryPoints(self, points: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Gets a containment mask for an N×2 array of points, along with the closest edge
+        index and edge normal of every contained point (-1 and zero for the others).'''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        mask = self.containsPoints(points)
+        edge_indices = np.full(len(points), -1, dtype=np.int64)
+        normals = np.zeros_like(points)
+        edge_indices[mask], normals[mask] = self.getClosestEdges(points[mask])
+        return (mask, edge_indices, normals)
+
 
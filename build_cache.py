@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from hashlib import sha256
+import os
+import numpy as np
+from pygame import Surface, surfarray
+from simulation_builder import Scene, buildScene
+
+# Bump whenever buildScene builds something different from the same canvas, or the saved format changes,
+# so that scenes saved by older builders are never loaded
+BUILD_VERSION = 3
+
+def sceneKey(canvas: Surface, softbody_color, staticbody_color, edge_tolerance, build_voxel_size,
+             particle_mass, spring_k, max_cell_size=1) -> str:
+    '''Hash of the builder version, the canvas pixels and every build parameter.
+    Equal keys build equal scenes.'''
+    key = sha256()
+    key.update(f'build {BUILD_VERSION}'.encode())
+    # Transposed so that rows are contiguous and tobytes does not have to reorder them
+    key.update(surfarray.pixels2d(canvas).T.tobytes())
+    key.update(repr((canvas.get_size(), tuple(softbody_color), tuple(staticbody_color), edge_tolerance,
+                     build_voxel_size, particle_mass, spring_k, max_cell_size)).encode())
+    return key.hexdigest()
+
+
+def _isKey(name: str) -> bool:
+    return len(name) == 2 * sha256().digest_size and all(character in '0123456789abcdef' for character in name)
+
+
+class BuildCache:
+    '''Built scenes by sceneKey, kept in memory up to a number of scenes (least
+    recently used first out) and, with a directory, saved to disk so that they
+    survive restarts. The directory keeps up to disk_capacity scenes, dropping the
+    least recently used (by file modification time) first.'''
+
+    CAPACITY = 8
+    DISK_CAPACITY = 64
+
+    def __init__(self, capacity=CAPACITY, directory: str = None, disk_capacity=DISK_CAPACITY):
+        self.capacity = capacity
+        self.directory = directory
+        self.disk_capacity = disk_capacity
+        self.scenes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def get(self, key: str) -> Scene:
+        '''The cached scene, or None.'''
+        if key in self.scenes:
+            self.scenes.move_to_end(key)
+            return self.scenes[key]
+        if self.directory is not None and os.path.exists(self._path(key)):
+            scene = loadScene(self._path(key))
+            # Marks the file as recently used, for _evictFiles
+            os.utime(self._path(key))
+            self._remember(key, scene)
+            return scene
+        return None
+
+    def put(self, key: str, scene: Scene):
+        self._remember(key, scene)
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            saveScene(self._path(key), scene)
+            self._evictFiles()
+
+    def _evictFiles(self):
+        '''Deletes the least recently used scene files beyond disk_capacity. Only files
+        named like a saved scene are touched.'''
+        paths = [entry.path for entry in os.scandir(self.directory)
+                 if entry.name.endswith('.npz') and _isKey(entry.name[:-len('.npz')])]
+        if len(paths) <= self.disk_capacity:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.disk_capacity]:
+            os.remove(path)
+
+    def _remember(self, key: str, scene: Scene):
+        self.scenes[key] = scene
+        self.scenes.move_to_end(key)
+        while len(self.scenes) > self.capacity:
+            self.scenes.popitem(last=False)
+
+    def build(self, canvas: Surface, softbody_color, staticbody_color, edge_tolerance, build_voxel_size,
+              particle_mass, spring_k, max_cell_size=1, build_scene=None) -> Scene:
+        '''Builds the scene of a canvas (see buildScene), or loads it if the same canvas
+        was built with the same parameters before. build_scene, when given, builds the
+        scene in place of buildScene (e.g. IncrementalBuilder.scene).'''
+        parameters = (softbody_color, staticbody_color, edge_tolerance, build_voxel_size, particle_mass, spring_k,
+                      max_cell_size)
+        key = sceneKey(canvas, *parameters)
+        scene = self.get(key)
+        if scene is not None:
+            self.hits += 1
+            return scene
+        self.misses += 1
+        scene = buildScene(canvas, *parameters) if build_scene is None else build_scene()
+        self.put(key, scene)
+        return scene
+
+
+'''Scenes are saved as .npz files of plain arrays. The rings of the static shapes are
+stored one after another, with their lengths and the shape each belongs to.'''
+
+def saveScene(path: str, scene: Scene):
+    rings, ring_shapes, ring_is_hole = [], [], []
+    for shape, (outer, holes) in enumerate(scene.static_shapes):
+        for ring, is_hole in [(outer, False)] + [(hole, True) for hole in holes]:
+            rings.append(np.array(ring, dtype=float).reshape(-1, 2))
+            ring_shapes.append(shape)
+            ring_is_hole.append(is_hole)
+    # Write to a temporary file first so that an interrupted save never leaves a broken scene
+    temporary_path = f'{path}.tmp.npz'
+    np.savez(temporary_path, positions=scene.positions, bonds=scene.bonds, cell_sides=scene.cell_sides,
+             ring_points=np.concatenate(rings) if rings else np.zeros((0, 2)),
+             ring_lengths=np.array([len(ring) for ring in rings], dtype=np.int64),
+             ring_shapes=np.array(ring_shapes, dtype=np.int64), ring_is_hole=np.array(ring_is_hole, dtype=bool),
+             particle_mass=scene.particle_mass, spring_k=scene.spring_k)
+    os.replace(temporary_path, path)
+
+def loadScene(path: str) -> Scene:
+    with np.load(path) as data:
+        ring_points = np.split(data['ring_points'], np.cumsum(data['ring_lengths'])[:-1])
+        static_shapes = []
+        for points, shape, is_hole in zip(ring_points, data['ring_shapes'], data['ring_is_hole']):
+            ring = [tuple(point) for point in points.tolist()]
+            if is_hole:
+                static_shapes[shape][1].append(ring)
+            else:
+                static_shapes.append((ring, []))
+        return Scene(data['positions'], data['bonds'], static_shapes,
+                     data['particle_mass'].item(), data['spring_k'].item(), data['cell_sides'])
@@ -0,0 +1,125 @@
+import numpy as np
+
+# Neighbour directions as (dx, dy) in clockwise order on screen, starting from +y
+_CLOCKWISE = [(0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1)]
+_RIGHT = 0  # Index of (0, 1), the next pixel along the scan direction
+
+def boundaryMask(mask: np.ndarray) -> np.ndarray:
+    '''Gets the pixels of a boolean mask that have at least one of their 8 neighbours
+    outside the mask. Pixels past the edge of the array count as outside.'''
+    padded = np.pad(mask, 1, constant_values=False)
+    interior = mask.copy()
+    width, height = mask.shape
+    for dx, dy in _CLOCKWISE:
+        interior &= padded[1 + dx:1 + dx + width, 1 + dy:1 + dy + height]
+    return mask & ~interior
+
+
+def traceContours(mask: np.ndarray) -> list[tuple[list[tuple], list[list[tuple]]]]:
+    '''Traces the borders of the 8-connected regions of a boolean mask indexed [x][y].
+    Returns one (outer, holes) pair per region, where outer is the ordered loop of
+    the region's outer border pixels and holes are the ordered loops of the borders
+    of the holes inside it.
+
+    This is Suzuki and Abe's border following. Only boundary pixels can start or
+    label a border, so the raster scan just visits those, and each border is then
+    followed once, keeping the whole trace linear in the number of boundary pixels.'''
+    width, height = mask.shape
+    stride = height + 2
+    # Flat padded label image: 0 outside, 1 unvisited, +-n once on border n
+    labels = np.pad(mask, 1, constant_values=False).astype(np.int64).ravel().tolist()
+    offsets = [dx*stride + dy for dx, dy in _CLOCKWISE]
+    direction_of = {offset: direction for direction, offset in enumerate(offsets)}
+
+    # Border 1 is the frame around the image, which behaves like a hole
+    is_hole = [None, True]
+    parents = [None, None]
+    loops = [None, None]
+
+    boundary_x, boundary_y = np.nonzero(boundaryMask(mask))
+    last_row = None
+    for start in ((boundary_x + 1) * stride + boundary_y + 1).tolist():
+        row = start // stride
+        if row != last_row:
+            last_row = row
+            last_border = 1
+
+        value = labels[start]
+        if value == 1 and labels[start - 1] == 0:
+            hole = False
+            previous = start - 1
+        elif value >= 1 and labels[start + 1] == 0:
+            hole = True
+            previous = start + 1
+            if value > 1:
+                last_border = value
+        else:
+            if value != 1:
+                last_border = abs(value)
+            continue
+
+        border = len(loops)
+        if hole == is_hole[last_border]:
+            parent = parents[last_border]
+        else:
+            parent = last_border
+        is_hole.append(hole)
+        parents.append(parent)
+        loops.append(_followBorder(labels, start, previous, border, offsets, direction_of))
+
+        if labels[start] != 1:
+            last_border = abs(labels[start])
+
+    to_points = lambda loop: [(index // stride - 1, index % stride - 1) for index in loop]
+    results = []
+    children = {}
+    for border in range(2, len(loops)):
+        if is_hole[border]:
+            children.setdefault(parents[border], []).append(border)
+    for border in range(2, len(loops)):
+        if is_hole[border]:
+            continue
+        results.append((to_points(loops[border]),
+                        [to_points(loops[hole]) for hole in children.get(border, [])]))
+    return results
+
+
+def _followBorder(labels, start, previous, border, offsets, direction_of) -> list[int]:
+    '''Follows one border from the start pixel, given the outside pixel it was entered
+    from, labelling it as it goes. Returns the flat indices of the border pixels.'''
+    # Look clockwise around the start pixel for the first pixel of the region
+    first_direction = direction_of[previous - start]
+    first = None
+    for step in range(8):
+        neighbour = start + offsets[(first_direction + step) % 8]
+        if labels[neighbour] != 0:
+            first = neighbour
+            break
+    if first is None:
+        # Isolated pixel
+        labels[start] = -border
+        return [start]
+
+    loop = [start]
+    previous, current = first, start
+    while True:
+        # Look counterclockwise around the current pixel, starting after the previous one
+        direction = direction_of[previous - current]
+        right_is_outside = False
+        for step in range(1, 9):
+            neighbour_direction = (direction - step) % 8
+            neighbour = current + offsets[neighbour_direction]
+            if labels[neighbour] != 0:
+                break
+            if neighbour_direction == _RIGHT:
+                right_is_outside = True
+
+        if right_is_outside:
+            labels[current] = -border
+        elif labels[current] == 1:
+            labels[current] = border
+
+        if neighbour == start and current == first:
+            return loop
+        previous, current = current, neighbour
+        loop.append(current)
@@ -1,28 +1,61 @@
 from dynamic_object import Renderable
-from pygame import mouse, draw, SRCALPHA, Surface, surfarray
+from pygame import mouse, draw, SRCALPHA, Surface, Rect, surfarray
+import numpy as np
 
-# Taken from https://stackoverflow.com/questions/41656764/how-to-implement-flood-fill-in-a-pygame-surface
-def floodFill(canvas: Surface, color, start_position):
+def floodFill(canvas: Surface, color, start_position) -> Rect:
+    '''Fills the 4-connected region of the start pixel's color and returns the
+    rectangle it changed. The region is found as connected horizontal runs of pixels:
+    runs are labelled with NumPy, links between overlapping runs in neighbouring rows
+    are found at each run's first pixel, and only the run graph is walked in Python.'''
     color = canvas.map_rgb(color)  # Convert the color to mapped integer value.
-    surf_array = surfarray.pixels2d(canvas)  # Create an array from the surface.
-    current_color = surf_array[start_position]  # Get the mapped integer color value.
+    # Writes go straight to the surface. Transposed so that rows are contiguous.
+    pixel_rows = surfarray.pixels2d(canvas).T
+    height, width = pixel_rows.shape
+    x, y = start_position
+    if not ((0 <= x < width) and (0 <= y < height)):
+        return Rect(0, 0, 0, 0)
+    current_color = pixel_rows[y, x]  # Get the mapped integer color value.
+    if current_color == color:
+        return Rect(0, 0, 0, 0)
 
-    frontier = [start_position]
+    '''Label every horizontal run of the start color, in raster order.'''
+    matching = pixel_rows == current_color
+    run_starts = matching.copy()
+    run_starts[:, 1:] &= ~matching[:, :-1]
+    run_ids = np.cumsum(run_starts.ravel(), dtype=np.int32).reshape(height, width) - 1
+    start_y, start_x = np.nonzero(run_starts)
+
+    '''Link runs that overlap in neighbouring rows. Of two overlapping runs, the one
+    that starts further right has its first pixel alongside the other.'''
+    sources, targets = [], []
+    for dy in (-1, 1):
+        neighbour_y = start_y + dy
+        runs = np.flatnonzero((neighbour_y >= 0) & (neighbour_y < height))
+        runs = runs[matching[neighbour_y[runs], start_x[runs]]]
+        neighbour_runs = run_ids[neighbour_y[runs], start_x[runs]]
+        sources += [runs, neighbour_runs]
+        targets += [neighbour_runs, runs]
+    sources = np.concatenate(sources)
+    order = np.argsort(sources, kind='stable')
+    linked_runs = np.concatenate(targets)[order].tolist()
+    link_offsets = np.searchsorted(sources[order], np.arange(len(start_x) + 1)).tolist()
+
+    '''Walk the run graph from the start pixel's run.'''
+    reached = [False] * len(start_x)
+    first_run = int(run_ids[y, x])
+    reached[first_run] = True
+    frontier = [first_run]
     while len(frontier) > 0:
-        x, y = frontier.pop()
-        try:  # Add a try-except block in case the position is outside the surface.
-            if surf_array[x, y] != current_color:
-                continue
-        except IndexError:
-            continue
-        surf_array[x, y] = color
-        # Then we append the neighbours of the pixel in the current position to our 'frontier' list.
-        frontier.append((x + 1, y))
-        frontier.append((x - 1, y))
-        frontier.append((x, y + 1))
-        frontier.append((x, y - 1))
-
-    surfarray.blit_array(canvas, surf_array)
+        run = frontier.pop()
+        for linked_run in linked_runs[link_offsets[run]:link_offsets[run + 1]]:
+            if not reached[linked_run]:
+                reached[linked_run] = True
+                frontier.append(linked_run)
+
+    matching &= np.array(reached)[run_ids]
+    pixel_rows[matching] = color
+    filled_y, filled_x = np.nonzero(matching.any(axis=1)), np.nonzero(matching.any(axis=0))
+    return Rect(filled_x[0][0], filled_y[0][0], filled_x[0][-1] + 1 - filled_x[0][0], filled_y[0][-1] + 1 - filled_y[0][0])
 
 
 class BrushColors:
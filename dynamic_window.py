@@ -1,4 +1,5 @@
-from time import time
+from time import perf_counter
+from profiler import profiler
 import pygame
 
 pygame.init()
@@ -14,6 +15,8 @@ class DynamicWindow:
         self.is_running = False
         self.screen = None
         self.frame = 0
+        # Screen regions drawn to in the last frame, when render returned any
+        self.last_dirty_rects = None
 
     def start(self):
         self.screen = pygame.display.set_mode(self.resolution)
@@ -21,27 +24,40 @@ class DynamicWindow:
 
         dt = 0
         while self.is_running:
-            start_time = time()
+            start_time = perf_counter()
             
-            events = pygame.event.get()
-            for event in events:
-                
-                if event.type == pygame.QUIT:
-                    self.is_running = False
-                    pygame.quit()
-                    break
+            with profiler.section('frame/events'):
+                events = pygame.event.get()
+                for event in events:
+
+                    if event.type == pygame.QUIT:
+                        self.is_running = False
+                        pygame.quit()
+                        break
 
             if not self.is_running:
                 break
 
-            self.update(dt, events)
-            self.render(self.screen, self.resolution)
-            pygame.display.flip()
-
-            self.screen.fill(self.bg_color)
+            with profiler.section('frame/update'):
+                self.update(dt, events)
+            with profiler.section('frame/render'):
+                dirty_rects = self.render(self.screen, self.resolution)
+            with profiler.section('frame/flip'):
+                self.present(dirty_rects)
+                self.screen.fill(self.bg_color)
             self.frame += 1
 
-            dt = time() - start_time
+            dt = perf_counter() - start_time
+            profiler.record('frame', start_time, dt)
+
+    def present(self, dirty_rects):
+        '''Shows the frame. When render returns the regions it drew to, only those and
+        the regions drawn to in the frame before (which now need clearing) are updated.'''
+        if dirty_rects is None or self.last_dirty_rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.last_dirty_rects + dirty_rects)
+        self.last_dirty_rects = dirty_rects
 
     def stop(self):
         self.is_running = False
@@ -50,4 +66,6 @@ class DynamicWindow:
         pass
 
     def render(self, screen, res):
+        '''Draws the frame. May return a list of the screen regions drawn to, in which
+        case only those are updated on the display.'''
         pass
\ No newline at end of file
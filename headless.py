@@ -0,0 +1,130 @@
+'''Runs a simulation from a canvas image without a display, for large scenes on servers
+and for reproducing performance problems outside the interactive app.
+
+    python headless.py canvas.png --steps 1000 --output run.json
+'''
+import os
+# Must be set before pygame is initialised
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+from argparse import ArgumentParser
+from time import perf_counter
+import json
+import numpy as np
+import pygame
+from pygame import Surface, surfarray
+from drawing import BrushColors
+from main import Simulation, SimulationState
+from distance_field import DistanceField
+from recording import Recorder, ENCODINGS
+
+PALETTE = (BrushColors.softbody, BrushColors.staticbody, BrushColors.erase)
+
+def loadCanvas(path: str) -> Surface:
+    '''Loads an image as a canvas, snapping every pixel to the closest BrushColors
+    color so that scaled or lossy images still build.'''
+    image = pygame.image.load(path)
+    canvas = Surface(image.get_size())
+    canvas.blit(image, (0, 0))
+
+    pixels = surfarray.pixels3d(canvas)
+    palette = np.array(PALETTE, dtype=np.int32)
+    squared_dists = ((pixels[:, :, None, :].astype(np.int32) - palette)**2).sum(axis=3)
+    pixels[:] = palette[np.argmin(squared_dists, axis=2)]
+    del pixels
+    return canvas
+
+
+def runHeadless(canvas: Surface, steps: int, dt: float,
+                edge_tolerance=Simulation.EDGE_TOLERANCE,
+                build_voxel_size=Simulation.BUILD_VOXEL_SIZE,
+                particle_mass=Simulation.PARTICLE_MASS,
+                spring_k=Simulation.SPRING_K,
+                max_cell_size=Simulation.MAX_CELL_SIZE,
+                static_collision=Simulation.STATIC_COLLISION,
+                workers=0,
+                recorder_path=None,
+                record_every=1,
+                encoding='delta') -> dict:
+    '''Builds the canvas and runs a fixed number of fixed steps. Returns the build time,
+    the wall time of every step and the final particle state. With workers, steps on
+    that many worker processes. With recorder_path, records every record_every'th
+    step (see recording.py).'''
+    start_time = perf_counter()
+    state = SimulationState.fromCanvas(canvas, BrushColors.softbody, BrushColors.staticbody,
+                                       edge_tolerance, build_voxel_size, particle_mass, spring_k, max_cell_size)
+    if static_collision == 'sdf':
+        state.distance_field = DistanceField.fromCanvas(canvas, BrushColors.staticbody)
+    build_time = perf_counter() - start_time
+
+    state.useWorkers(workers)
+    recorder = None
+    if recorder_path is not None:
+        recorder = Recorder(recorder_path, state, canvas.get_size(), encoding, dt * record_every)
+        recorder.capture(state.world.particles.pos)
+    step_times = []
+    for step in range(1, steps + 1):
+        start_time = perf_counter()
+        state.update(dt)
+        step_times.append(perf_counter() - start_time)
+        if recorder is not None and step % record_every == 0:
+            recorder.capture(state.world.particles.pos)
+    state.close()
+    if recorder is not None:
+        recorder.close()
+
+    indices = state.particle_indices
+    return {
+        'canvas_size': list(canvas.get_size()),
+        'steps': steps,
+        'dt': dt,
+        'workers': workers,
+        'static_collision': static_collision,
+        'build_parameters': {'edge_tolerance': edge_tolerance, 'build_voxel_size': build_voxel_size,
+                             'particle_mass': particle_mass, 'spring_k': spring_k, 'max_cell_size': max_cell_size},
+        'particles': len(indices),
+        'spring_bonds': state.springs.count,
+        'staticbodies': len(state.staticbodies),
+        'static_vertices': sum(len(staticbody.shape.edge_ends) for staticbody in state.staticbodies),
+        'islands': state.islands.island_count if state.islands is not None else 0,
+        # Islands still asleep at the end, which a settled scene no longer steps
+        'sleeping_islands': int(state.islands.asleep.sum()) if state.islands is not None else 0,
+        'build_time': build_time,
+        'step_times': step_times,
+        'final_state': {'pos': state.world.particles.pos[indices].tolist(),
+                        'vel': state.world.particles.vel[indices].tolist()},
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Run a softbody simulation from a canvas image without a display.')
+    parser.add_argument('canvas', help='image painted with the BrushColors palette')
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--dt', type=float, default=Simulation.PHYSICS_DT)
+    parser.add_argument('--output', default='headless_run.json')
+    parser.add_argument('--edge-tolerance', type=float, default=Simulation.EDGE_TOLERANCE)
+    parser.add_argument('--voxel-size', type=int, default=Simulation.BUILD_VOXEL_SIZE)
+    parser.add_argument('--particle-mass', type=float, default=Simulation.PARTICLE_MASS)
+    parser.add_argument('--spring-k', type=float, default=Simulation.SPRING_K)
+    parser.add_argument('--max-cell-size', type=int, default=Simulation.MAX_CELL_SIZE,
+                        help='voxels a side of the coarsest interior cells, 1 for a uniform mesh')
+    parser.add_argument('--static-collision', choices=('polygon', 'sdf'), default=Simulation.STATIC_COLLISION,
+                        help='collide with the staticbody polygons or with a distance field of the canvas')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes to step on, 0 for none')
+    parser.add_argument('--record', metavar='PATH', help='record the run for replay.py')
+    parser.add_argument('--record-every', type=int, default=1, help='record every nth step')
+    parser.add_argument('--encoding', choices=ENCODINGS, default='delta')
+    args = parser.parse_args()
+
+    result = runHeadless(loadCanvas(args.canvas), args.steps, args.dt,
+                         args.edge_tolerance, args.voxel_size, args.particle_mass, args.spring_k, args.max_cell_size,
+                         args.static_collision, args.workers,
+                         args.record, args.record_every, args.encoding)
+    with open(args.output, 'w') as file:
+        json.dump(result, file)
+
+    step_times = np.array(result['step_times'])
+    print(f'{result["particles"]} particles, {result["spring_bonds"]} bonds, {result["staticbodies"]} staticbodies '
+          f'with {result["static_vertices"]} vertices, {result["sleeping_islands"]} of {result["islands"]} islands asleep')
+    print(f'build {1000*result["build_time"]:.1f}ms, step mean {1000*step_times.mean():.2f}ms '
+          f'p95 {1000*np.percentile(step_times, 95):.2f}ms -> {args.output}')
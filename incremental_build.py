@@ -0,0 +1,132 @@
+from threading import Thread
+from queue import Queue, Empty
+import numpy as np
+from pygame import Surface, Rect, surfarray
+from contours import traceContours
+from simulation_builder import Scene, simplifyShapes, meshOccupancy
+
+class IncrementalBuilder(Thread):
+    '''Keeps what buildScene computes from a canvas, the softbody voxel occupancy and
+    the staticbody outlines, up to date on a background thread while the canvas is
+    drawn on, so that building the scene afterwards only has to mesh the voxels.
+
+    Draw operations report the rectangles they changed with markDirty, which copies
+    those pixels for the thread. The thread resamples the voxels inside them and
+    retraces only the outlines of the staticbody regions that the changes touch.'''
+
+    def __init__(self, canvas: Surface, softbody_color, staticbody_color, edge_tolerance, build_voxel_size,
+                 particle_mass, spring_k, max_cell_size=1):
+        super().__init__(daemon=True)
+        self.softbody_color = canvas.map_rgb((softbody_color[0], softbody_color[1], softbody_color[2], 255))
+        self.staticbody_color = canvas.map_rgb((staticbody_color[0], staticbody_color[1], staticbody_color[2], 255))
+        self.edge_tolerance = edge_tolerance
+        self.voxel_size = build_voxel_size
+        self.particle_mass = particle_mass
+        self.spring_k = spring_k
+        self.max_cell_size = max_cell_size
+        self.bounds = canvas.get_rect()
+        self.updates = Queue()
+
+        # The thread's own copy of the canvas, and what it has built from it
+        self.pixels = surfarray.array2d(canvas)
+        half_voxel = int(build_voxel_size/2)
+        self.occupied = self.pixels[half_voxel::build_voxel_size, half_voxel::build_voxel_size] == self.softbody_color
+        self.static_mask = self.pixels == self.staticbody_color
+        # Traced (outer, holes) outlines and the (left, top, right, bottom) pixel bounds of each
+        self.shapes = []
+        self.shape_bounds = np.zeros((0, 4), dtype=np.int64)
+        self._retrace((0, 0, self.bounds.width, self.bounds.height))
+
+    def markDirty(self, canvas: Surface, rect: Rect):
+        '''Queues the pixels of the canvas inside rect to be rebuilt. Called from the
+        thread that draws on the canvas, right after drawing.'''
+        rect = Rect(rect).clip(self.bounds)
+        if rect.width == 0 or rect.height == 0:
+            return
+        patch = surfarray.pixels2d(canvas)[rect.left:rect.right, rect.top:rect.bottom].copy()
+        self.updates.put((rect, patch))
+
+    def stop(self):
+        self.updates.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            updates = [self.updates.get()]
+            # Handle every change made since the last round at once
+            while True:
+                try:
+                    updates.append(self.updates.get_nowait())
+                except Empty:
+                    break
+            running = None not in updates
+            self._apply([update for update in updates if update is not None])
+            for _ in updates:
+                self.updates.task_done()
+            if not running:
+                return
+
+    def _apply(self, updates):
+        changed, static_changed = None, None
+        for rect, patch in updates:
+            box = (rect.left, rect.top, rect.right, rect.bottom)
+            window = (slice(rect.left, rect.right), slice(rect.top, rect.bottom))
+            self.pixels[window] = patch
+            static_patch = patch == self.staticbody_color
+            if not np.array_equal(static_patch, self.static_mask[window]):
+                self.static_mask[window] = static_patch
+                static_changed = _union(static_changed, box)
+            changed = _union(changed, box)
+        if changed is None:
+            return
+
+        # Resample the voxels whose centre pixel changed
+        half_voxel = int(self.voxel_size/2)
+        first = [max(0, -((half_voxel - low) // self.voxel_size)) for low in changed[:2]]
+        last = [-((half_voxel - high) // self.voxel_size) for high in changed[2:]]
+        voxels = (slice(first[0], last[0]), slice(first[1], last[1]))
+        self.occupied[voxels] = self.pixels[half_voxel + first[0]*self.voxel_size:changed[2]:self.voxel_size,
+                                            half_voxel + first[1]*self.voxel_size:changed[3]:self.voxel_size] == self.softbody_color
+        if static_changed is not None:
+            self._retrace(static_changed)
+
+    def _retrace(self, box):
+        '''Retraces the staticbody outlines around a changed box. Regions that do not
+        come within a pixel of it (or of another retraced region) keep their outlines.'''
+        retraced = np.zeros(len(self.shapes), dtype=bool)
+        while True:
+            near = (~retraced & (self.shape_bounds[:, 0] <= box[2]) & (self.shape_bounds[:, 2] >= box[0])
+                    & (self.shape_bounds[:, 1] <= box[3]) & (self.shape_bounds[:, 3] >= box[1]))
+            if not near.any():
+                break
+            retraced |= near
+            for bounds in self.shape_bounds[near].tolist():
+                box = _union(box, bounds)
+
+        # Trace a pixel past the box, so that the regions inside it are surrounded by background
+        left, top = max(0, box[0] - 1), max(0, box[1] - 1)
+        right, bottom = min(self.bounds.width, box[2] + 1), min(self.bounds.height, box[3] + 1)
+        offset = lambda loop: [(x + left, y + top) for x, y in loop]
+        traced = [(offset(outer), [offset(hole) for hole in holes])
+                  for outer, holes in traceContours(self.static_mask[left:right, top:bottom])]
+
+        self.shapes = [shape for shape, keep in zip(self.shapes, ~retraced) if keep] + traced
+        new_bounds = [[*np.min(outer, axis=0), *(np.max(outer, axis=0) + 1)] for outer, _ in traced]
+        self.shape_bounds = np.concatenate([self.shape_bounds[~retraced],
+                                            np.array(new_bounds, dtype=np.int64).reshape(-1, 4)])
+
+    def scene(self) -> Scene:
+        '''Waits for the queued changes to be built and returns the scene, the same as
+        buildScene on the canvas would.'''
+        self.updates.join()
+        positions, bonds, sides = meshOccupancy(self.occupied, self.voxel_size, self.max_cell_size)
+        # In the order a full trace finds them: by the first pixel of their outer border
+        shapes = sorted(self.shapes, key=lambda shape: shape[0][0])
+        return Scene(positions, bonds, simplifyShapes(shapes, self.edge_tolerance), self.particle_mass, self.spring_k,
+                     sides)
+
+
+def _union(box, other) -> tuple:
+    if box is None:
+        return tuple(other)
+    return (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
@@ -0,0 +1,152 @@
+import numpy as np
+from particle_array import ParticleArray
+from spring_array import SpringArray
+
+def findIslands(count: int, i1: np.ndarray, i2: np.ndarray) -> np.ndarray:
+    '''Connected components of the graph of count nodes with edges (i1, i2). Returns
+    the component of every node, numbered from 0 in order of their lowest node.'''
+    labels = np.arange(count)
+    if len(i1) == 0:
+        return labels
+    while True:
+        # Hook the root of each edge's larger end onto the smaller root...
+        low = np.minimum(labels[i1], labels[i2])
+        np.minimum.at(labels, labels[i1], low)
+        np.minimum.at(labels, labels[i2], low)
+        # ...and point every node straight at its root
+        while True:
+            roots = labels[labels]
+            if np.array_equal(roots, labels):
+                break
+            labels = roots
+        if np.array_equal(labels[i1], labels[i2]):
+            return np.unique(labels, return_inverse=True)[1]
+
+
+class IslandSleeper:
+    '''Puts islands (groups of particles connected by springs) to sleep once they come
+    to rest, so that the simulation can skip them.
+
+    An island is calm while its centre of mass is slower than half the speed gravity
+    gives it over SLEEP_STEPS steps, and has stayed close enough to where it was when
+    the island became calm that it has averaged under SLEEP_SPEED since. Falling
+    freely, the velocity of its centre of mass changes by all of that over the steps,
+    so only islands held up by contacts sleep, however much their particles jitter
+    against them, and only once they have stopped sliding along them. Islands in
+    contact with each other sleep together, once all of them have been calm for
+    SLEEP_STEPS steps. Sleeping particles have zero velocity and force, and an island
+    wakes when one of its particles is moved or given a velocity or force, or when an
+    awake particle comes within contact range of it.'''
+
+    SLEEP_STEPS = 120
+    SLEEP_SPEED = 0.5 # Pixels per second, the fastest an island's centre of mass may drift while calm
+
+    def __init__(self, particle_indices, springs: SpringArray, gravity):
+        self.gravity = float(np.hypot(*gravity))
+        self.particle_indices = np.asarray(particle_indices, dtype=int)
+        # Local numbering of the state's own particles, and the bonds between them
+        self.local = np.full(1 + self.particle_indices.max(initial=-1), -1)
+        self.local[self.particle_indices] = np.arange(len(self.particle_indices))
+        i1, i2 = springs.i1[:springs.count], springs.i2[:springs.count]
+        in_range = (i1 < len(self.local)) & (i2 < len(self.local))
+        self.bond_indices = np.flatnonzero(in_range)[(self.local[i1[in_range]] >= 0) & (self.local[i2[in_range]] >= 0)]
+        local_i1, local_i2 = self.local[i1[self.bond_indices]], self.local[i2[self.bond_indices]]
+
+        self.island_of = findIslands(len(self.particle_indices), local_i1, local_i2)
+        self.island_count = int(self.island_of.max(initial=-1)) + 1
+        self.island_sizes = np.bincount(self.island_of, minlength=self.island_count)
+        self.bond_islands = self.island_of[local_i1]
+
+        self.asleep = np.zeros(self.island_count, dtype=bool)
+        self.calm_steps = np.zeros(self.island_count, dtype=np.int64)
+        # Centre of mass of each island when it last became calm
+        self.calm_centers = np.zeros((self.island_count, 2))
+        self.sleep_pos = np.zeros((0, 2))
+        # Pairs of awake islands found touching in the last contact check
+        self.touching = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        self._updateAwake()
+
+    def _updateAwake(self):
+        awake = ~self.asleep[self.island_of]
+        self.awake_local = np.flatnonzero(awake)
+        self.sleeping_local = np.flatnonzero(~awake)
+        self.awake_particles = self.particle_indices[self.awake_local]
+        self.sleeping_particles = self.particle_indices[self.sleeping_local]
+        self.awake_bonds = self.bond_indices[~self.asleep[self.bond_islands]]
+
+    def wake(self, islands):
+        self.asleep[islands] = False
+        self.calm_steps[islands] = 0
+        self._updateAwake()
+
+    def wakeDisturbed(self, store: ParticleArray):
+        '''Wakes the islands of sleeping particles that have been moved or given a
+        velocity or force since they fell asleep.'''
+        sleeping = self.sleeping_particles
+        if len(sleeping) == 0:
+            return
+        disturbed = ((store.pos[sleeping] != self.sleep_pos[sleeping]).any(axis=1)
+                     | (store.vel[sleeping] != 0).any(axis=1) | (store.force[sleeping] != 0).any(axis=1))
+        if disturbed.any():
+            self.wake(np.unique(self.island_of[self.sleeping_local[disturbed]]))
+
+    def wakeTouched(self, store: ParticleArray):
+        '''Wakes the islands that awake particles are in contact with, and notes which
+        awake islands touch each other. Particles that are not in an island (not the
+        state's own) are ignored. The store's broadphase must already be built over the
+        current positions.'''
+        awake = self.awake_particles
+        if len(awake) == 0:
+            return
+        pair_i, pair_j = store.broadphase.contactPairs(ParticleArray.CONTACT_RADIUS, awake)
+        own = pair_j < len(self.local)
+        own[own] = self.local[pair_j[own]] >= 0
+        island_i = self.island_of[self.local[pair_i[own]]]
+        island_j = self.island_of[self.local[pair_j[own]]]
+        touched_asleep = self.asleep[island_j]
+        if touched_asleep.any():
+            self.wake(np.unique(island_j[touched_asleep]))
+        different = island_i != island_j
+        self.touching = (island_i[different], island_j[different])
+
+    def update(self, store: ParticleArray, dt):
+        '''Counts how long each awake island has been calm and puts groups of touching
+        islands that have all been calm long enough to sleep.'''
+        awake, awake_islands = self.awake_particles, self.island_of[self.awake_local]
+        mass = store.mass[awake]
+        # Asleep islands have no awake particles, and no mass here
+        island_masses = np.maximum(np.bincount(awake_islands, mass, self.island_count), np.finfo(float).tiny)
+        weighted_mean = lambda values: np.stack([np.bincount(awake_islands, mass * values[:, axis], self.island_count)
+                                                 for axis in range(2)], axis=1) / island_masses[:, None]
+        island_vel, centers = weighted_mean(store.vel[awake]), weighted_mean(store.pos[awake])
+        # Islands that were not calm last step measure their drift from here
+        starting = self.calm_steps == 0
+        self.calm_centers[starting] = centers[starting]
+        drifts = centers - self.calm_centers
+
+        # Calm for SLEEP_STEPS updates spans SLEEP_STEPS - 1 steps
+        window = (IslandSleeper.SLEEP_STEPS - 1) * dt
+        fall_speed = self.gravity * window / 2
+        max_drift = IslandSleeper.SLEEP_SPEED * window
+        calm = (~self.asleep & (np.einsum('ij,ij->i', island_vel, island_vel) < fall_speed**2)
+                & (np.einsum('ij,ij->i', drifts, drifts) < max_drift**2))
+        self.calm_steps = np.where(calm, self.calm_steps + 1, 0)
+
+        # The least calm island of every group of touching islands holds the group awake
+        groups = findIslands(self.island_count, *self.touching)
+        group_calm_steps = np.full(groups.max(initial=-1) + 1, np.iinfo(np.int64).max)
+        np.minimum.at(group_calm_steps, groups, np.where(self.asleep, np.iinfo(np.int64).max, self.calm_steps))
+        falling_asleep = ~self.asleep & (group_calm_steps[groups] >= IslandSleeper.SLEEP_STEPS)
+        if not falling_asleep.any():
+            return
+
+        self.asleep |= falling_asleep
+        self._updateAwake()
+        sleeping = self.sleeping_particles
+        store.vel[sleeping] = 0
+        store.force[sleeping] = 0
+        if len(self.sleep_pos) < len(store.pos):
+            sleep_pos = np.zeros_like(store.pos)
+            sleep_pos[:len(self.sleep_pos)] = self.sleep_pos
+            self.sleep_pos = sleep_pos
+        self.sleep_pos[sleeping] = store.pos[sleeping]
@@ -2,48 +2,238 @@ from dynamic_window import DynamicWindow
 from particle import Particle
 from static_body import StaticBody
 from bounds import PolygonalBound
-from pygame import Vector2, mouse, Surface
+from pygame import mouse, Surface, Rect
 import pygame
-from random import randint
 from spring_bond import SpringBond
-from time import sleep
 from dynamic_object import Renderable, Updatable
 from drawing import DrawState, BrushColors, floodFill
-from simulation_builder import buildStaticbodies, buildSoftbodies
+from simulation_builder import Scene, buildScene, addSoftbodies
+from build_cache import BuildCache
+from incremental_build import IncrementalBuilder
+from physics_clock import PhysicsClock
+from static_layer import StaticLayer
+from parallel_step import ParallelStepper
+from islands import IslandSleeper
+from xpbd import XPBDSolver
+from distance_field import DistanceField
+from simulation_thread import SimulationThread
+from recording import Recorder, Recording
+from world import World
+from profiler import profiler
+import numpy as np
 
 class SimulationState(Updatable, Renderable):
 
+    GRAVITY = (0, 70)
+
     def __init__(self):
         self.setDefaults()
 
     @staticmethod
     def fromCanvas(canvas: Surface, softbody_color: tuple, staticbody_color: tuple, 
-                   edge_length: int, 
+                   edge_tolerance: float, 
                    build_voxel_size: int,
-                   particle_mass: int, spring_k: int):
+                   particle_mass: int, spring_k: int,
+                   max_cell_size: int = 1):
+        return SimulationState.fromScene(buildScene(canvas, softbody_color, staticbody_color, edge_tolerance,
+                                                    build_voxel_size, particle_mass, spring_k, max_cell_size))
+
+    @staticmethod
+    def fromScene(scene: Scene):
+        '''Adds the particles and bonds of a built scene to a new world and makes its
+        static bodies.'''
         state = SimulationState()
 
-        (state.particles, state.spring_bonds) = buildSoftbodies(canvas, softbody_color, build_voxel_size,
-                                                                particle_mass, spring_k)
-        state.staticbodies = buildStaticbodies(canvas, staticbody_color, edge_length)
+        addSoftbodies(state.world, scene.positions, scene.bonds, scene.particleMasses(), scene.spring_k)
+        state.world.addStaticbodies([StaticBody(PolygonalBound(outer, holes)) for outer, holes in scene.static_shapes])
+        state.particle_indices = state.world.live()
+        state.islands = IslandSleeper(state.particle_indices, state.springs, SimulationState.GRAVITY)
         
         return state
 
+    @staticmethod
+    def fromRecording(recording: Recording):
+        '''A state with a recording's bonds and static bodies, for drawing its frames
+        with renderPositions. Its particles are never stepped.'''
+        state = SimulationState()
+        state.particle_indices = state.world.spawn(np.zeros((recording.particle_count, 2)),
+                                                   np.zeros((recording.particle_count, 2)), 1)
+        # The bonds only need their ends, so their rest lengths are left at zero
+        state.springs.addMany(state.world.particles, recording.bonds[:, 0], recording.bonds[:, 1], 0)
+        state.world.addStaticbodies(recording.staticbodies())
+        return state
+
     def setDefaults(self):
-        self.spring_bonds = []
-        self.particles = []
-        self.staticbodies = []
+        self.world = World()
+        self.springs = self.world.springs
+        self.staticbodies = self.world.staticbodies
+        # Live particles of the world, replaced whenever particles are spawned or despawned
+        self.particle_indices = np.zeros(0, dtype=int)
+        # Particles that leave this rectangle are despawned, when set
+        self.bounds = None
+        self.static_layer = StaticLayer()
+        # Steps the simulation on worker processes when set (see useWorkers)
+        self.parallel_stepper = None
+        # Replaces the force based springs and integration when set (see XPBDSolver)
+        self.solver = None
+        # Tracks which softbodies are at rest and can be skipped (see IslandSleeper)
+        self.islands = None
+        # Collides the particles with the static geometry in place of the staticbody polygons when set
+        self.distance_field = None
+        # How far into the next physics step to draw the particles (see PhysicsClock.alpha)
+        self.render_alpha = 1
+
+    def applyGravity(self, indices):
+        store = self.world.particles
+        store.force[indices] += store.mass[indices, None] * SimulationState.GRAVITY
+
+    def spawn(self, positions, velocities, mass):
+        '''Adds free particles to the simulation.'''
+        self.world.spawn(positions, velocities, mass)
+        self._particlesChanged()
+
+    def despawn(self, indices):
+        '''Removes particles, and their bonds, from the simulation.'''
+        self.world.despawn(indices)
+        self._particlesChanged()
+
+    def despawnOutside(self, bounds: Rect):
+        '''Removes the particles outside bounds, and those whose positions are no longer
+        finite (e.g. after a step blew up).'''
+        store = self.world.particles
+        pos = store.pos[self.particle_indices]
+        # Comparisons with NaN are False, so only a position inside bounds in both axes stays
+        inside = ((pos[:, 0] >= bounds.left) & (pos[:, 0] < bounds.right)
+                  & (pos[:, 1] >= bounds.top) & (pos[:, 1] < bounds.bottom))
+        outside = ~inside
+        if outside.any():
+            self.despawn(self.particle_indices[outside])
+
+    def compact(self):
+        '''Packs the world's live particles together (see World.compact). Indices held
+        from before, e.g. by a Recorder, no longer apply.'''
+        self.world.compact()
+        self._particlesChanged()
+
+    def _particlesChanged(self):
+        self.particle_indices = self.world.live()
+        if self.islands is not None:
+            self.islands = IslandSleeper(self.particle_indices, self.springs, SimulationState.GRAVITY)
+        if self.parallel_stepper is not None:
+            self.parallel_stepper.setIndices(self.particle_indices)
+
+    def useWorkers(self, workers: int):
+        '''Steps the simulation on the given number of worker processes, or on this
+        process when 0. The workers step force based springs only, and step every
+        particle, so islands no longer sleep on them.'''
+        self.close()
+        if workers > 0:
+            if self.solver is not None:
+                raise ValueError(f'{type(self.solver).__name__} cannot step on worker processes, '
+                                 'only force based springs can')
+            self.islands = None
+            self.parallel_stepper = ParallelStepper(self.world.particles, self.springs, self.particle_indices,
+                                                    self.staticColliders(), SimulationState.GRAVITY, workers)
+
+    def staticColliders(self) -> list:
+        '''What the particles collide with: the distance field when set, or else every
+        staticbody.'''
+        return [self.distance_field] if self.distance_field is not None else self.staticbodies
+
+    def close(self):
+        '''Stops the worker processes, if any.'''
+        if self.parallel_stepper is not None:
+            self.parallel_stepper.close()
+            self.parallel_stepper = None
 
     def update(self, dt):
-        [spring_bond.update(dt) for spring_bond in self.spring_bonds]
-        [particle.update(dt) for particle in self.particles]
-        [staticbody.update(dt) for staticbody in self.staticbodies]
-
-    def render(self, screen):
-        [spring_bond.render(screen) for spring_bond in self.spring_bonds]
-        [particle.render(screen) for particle in self.particles]
-        [staticbody.render(screen) for staticbody in self.staticbodies]
-        
+        if self.bounds is not None:
+            self.despawnOutside(self.bounds)
+        if self.parallel_stepper is not None:
+            with profiler.section('update/parallel'):
+                self.parallel_stepper.step(dt)
+            return
+
+        if self.islands is None:
+            self.step(dt, self.particle_indices)
+            return
+
+        store = self.world.particles
+        islands = self.islands
+        islands.wakeDisturbed(store)
+        self.step(dt, islands.awake_particles, islands.awake_bonds, islands)
+        with profiler.section('update/islands'):
+            islands.update(store, dt)
+
+    def step(self, dt, particle_indices, bond_indices=None, islands: IslandSleeper = None):
+        '''Steps the given particles and bonds (all by default). Sleeping islands are
+        woken before collisions when the particles reach them.'''
+        store = self.world.particles
+        if self.solver is not None:
+            with profiler.section('update/solver'):
+                self.applyGravity(particle_indices)
+                self.solver.step(store, self.springs, dt, particle_indices, bond_indices)
+        else:
+            with profiler.section('update/springs'):
+                self.applyGravity(particle_indices)
+                self.springs.solve(store, bond_indices)
+            with profiler.section('update/integrate'):
+                store.savePositions()
+                store.integrate(dt, particle_indices)
+        with profiler.section('update/collisions'):
+            if islands is None:
+                store.resolveCollisions(particle_indices)
+            else:
+                # One broadphase build finds both the islands to wake and the collisions
+                store.broadphase.build(store.pos[:store.count])
+                islands.wakeTouched(store)
+                particle_indices = islands.awake_particles
+                store.resolveCollisions(particle_indices, built=True)
+        with profiler.section('update/staticbodies'):
+            if islands is None and self.distance_field is None:
+                [staticbody.update(dt) for staticbody in self.staticbodies]
+            elif len(particle_indices) > 0:
+                pos, vel = store.pos[particle_indices], store.vel[particle_indices]
+                prev_pos = store.prev_pos[particle_indices]
+                [collider.collide(pos, vel, dt, prev_pos) for collider in self.staticColliders()]
+                store.pos[particle_indices], store.vel[particle_indices] = pos, vel
+
+    def render(self, screen) -> list:
+        '''Draws the scene and returns the screen regions that may have changed since
+        the last frame.'''
+        store = self.world.particles
+        store.render_alpha = self.render_alpha
+        return self.renderPositions(screen, store.renderPositions(), self.particle_indices)
+
+    def renderSnapshot(self, screen, snapshot) -> list:
+        '''Draws the scene as it was when a SimulationThread took the snapshot.'''
+        return self.renderPositions(screen, snapshot.positions(), snapshot.particle_indices, snapshot.bond_ends)
+
+    def renderPositions(self, screen, positions, particle_indices, bond_ends=None) -> list:
+        '''Draws the scene with the particles at the given store-wide positions, which
+        may come from somewhere other than the live store (e.g. a snapshot), and the
+        bonds between the (i1, i2) particle index arrays of bond_ends (the live bonds
+        by default).'''
+        with profiler.section('render/springs'):
+            if bond_ends is None:
+                SpringBond.renderMany(screen, positions, self.springs)
+            else:
+                SpringBond.renderEnds(screen, positions, *bond_ends)
+        with profiler.section('render/particles'):
+            Particle.renderMany(screen, positions[particle_indices])
+        with profiler.section('render/staticbodies'):
+            if self.static_layer.render(screen, self.staticbodies):
+                return [screen.get_rect()]
+        return [self._dirtyRect(positions[particle_indices])]
+
+    def _dirtyRect(self, positions) -> Rect:
+        '''Bounding rectangle of everything drawn around the given particle positions.'''
+        if len(positions) == 0:
+            return Rect(0, 0, 0, 0)
+        margin = max(Particle.RENDER_RADIUS, SpringBond.RENDER_THICKNESS) + 1
+        (left, top), (right, bottom) = np.floor(positions.min(axis=0)), np.ceil(positions.max(axis=0))
+        return Rect(left - margin, top - margin, right - left + 2*margin, bottom - top + 2*margin)
+
 
 class Simulation(DynamicWindow):
     
@@ -55,10 +245,27 @@ class Simulation(DynamicWindow):
     BRUSH_MIN_RADIUS = 4
 
     BUILD_VOXEL_SIZE = 12 # Higher number = faster
-    EDGE_LENGTH = 50 # Higher number = faster
+    MAX_CELL_SIZE = 4 # Voxels a side that softbody interiors are merged into (see meshOccupancy), 1 for a uniform mesh
+    EDGE_TOLERANCE = 1.5 # Pixels the staticbody outlines may stray from the drawing. Higher number = fewer edges = faster
     PARTICLE_MASS = 1
     SPRING_K = 1000
 
+    PHYSICS_DT = 1/240 # Fixed physics step, independent of frame time
+    PHYSICS_WORKERS = 0 # Processes to step the physics on, 0 steps it on the main process
+    PHYSICS_SOLVER = 'force' # 'force' for force based springs, 'xpbd' for position based constraints (see XPBDSolver)
+    XPBD_ITERATIONS = XPBDSolver.ITERATIONS
+    STATIC_COLLISION = 'polygon' # 'polygon' to collide with every staticbody, 'sdf' with a distance field of the canvas (see DistanceField)
+    PHYSICS_THREAD = False # Step the physics on its own thread and render its latest finished step
+    MAX_SUBSTEPS = 16 # Most physics steps per frame before the simulation slows down
+    DESPAWN_MARGIN = 200 # Pixels beyond the window that particles can go before they are despawned
+
+    CANVAS_SAVE_PATH = 'canvas.png' # Where S saves the canvas, for replaying it with headless.py
+    PROFILE_TRACE_PATH = 'profile_trace.json' # Where F4 dumps the profiler as a Chrome trace
+    PROFILE_CSV_PATH = 'profile.csv' # and as CSV
+    RECORDING_PATH = 'recording.sbr' # Where R records the simulation, for replay.py
+    RECORDING_ENCODING = 'delta'
+    BUILD_CACHE_DIR = '.build_cache' # Where built scenes are kept across runs, None to only keep them in memory
+
     def __init__(self, resolution, bg_color):
         super().__init__(resolution, bg_color)
         self.setup()
@@ -76,8 +283,24 @@ class Simulation(DynamicWindow):
         # Is this frame the start of a simulation mode
         self.simulation_start = False
 
+        # Built scenes, so that building an unchanged canvas again is instant
+        self.build_cache = BuildCache(directory=Simulation.BUILD_CACHE_DIR)
+        # Builds the canvas in the background as it is drawn on, so that building a new canvas is quick too
+        self.incremental_build = IncrementalBuilder(self.draw_canvas, BrushColors.softbody, BrushColors.staticbody,
+                                                    Simulation.EDGE_TOLERANCE, Simulation.BUILD_VOXEL_SIZE,
+                                                    Simulation.PARTICLE_MASS, Simulation.SPRING_K,
+                                                    Simulation.MAX_CELL_SIZE)
+        self.incremental_build.start()
+
+        self.physics_clock = PhysicsClock(Simulation.PHYSICS_DT, Simulation.MAX_SUBSTEPS)
+        # Steps the simulation instead of the window loop when PHYSICS_THREAD is set
+        self.simulation_thread = None
+        # Captures a frame of the simulation every frame while set, toggled with R
+        self.recorder = None
+        # Toggled with F3
+        self.show_profiler = False
+
         self.test_statics = []
-        self.test_particles = []
 
     def updateDrawMode(self, dt, events):
         for event in events:
@@ -94,15 +317,21 @@ class Simulation(DynamicWindow):
 
                 '''Clear canvas'''
                 if event.key == pygame.K_BACKSPACE:
-                    self.draw_canvas.fill(BrushColors.erase)
+                    self.incremental_build.markDirty(self.draw_canvas, self.draw_canvas.fill(BrushColors.erase))
+
+                '''Save canvas'''
+                if event.key == pygame.K_s:
+                    pygame.image.save(self.draw_canvas, Simulation.CANVAS_SAVE_PATH)
 
                 '''Flood fill'''
                 if event.key == pygame.K_f:
                     match self.draw_state.brush:
                         case DrawState.BRUSH_SOFTBODY:
-                            floodFill(self.draw_canvas, BrushColors.softbody, mouse.get_pos())
+                            filled = floodFill(self.draw_canvas, BrushColors.softbody, mouse.get_pos())
+                            self.incremental_build.markDirty(self.draw_canvas, filled)
                         case DrawState.BRUSH_STATICBODY:
-                            floodFill(self.draw_canvas, BrushColors.staticbody, mouse.get_pos())
+                            filled = floodFill(self.draw_canvas, BrushColors.staticbody, mouse.get_pos())
+                            self.incremental_build.markDirty(self.draw_canvas, filled)
 
             # Reset the last drawn position to none when user stops drawing
             if event.type == pygame.MOUSEBUTTONUP:
@@ -127,8 +356,14 @@ class Simulation(DynamicWindow):
                                                                   self.draw_state.eraser_radius + r_delta))
 
     def updateSimulateMode(self, dt, events):
-        [p.applyForce(p.mass * Vector2(0,70)) for p in self.simulation_state.particles]
-        self.simulation_state.update(dt)
+        if self.simulation_thread is not None:
+            return
+        for _ in range(self.physics_clock.advance(dt)):
+            self.simulation_state.update(self.physics_clock.fixed_dt)
+        # Compacting renumbers the particles, which would break a recording in progress
+        if self.recorder is None and self.simulation_state.world.sparse():
+            self.simulation_state.compact()
+        self.simulation_state.render_alpha = self.physics_clock.alpha
 
     def renderDrawMode(self, screen):
         mouse_buttons = mouse.get_pressed()
@@ -149,25 +384,80 @@ class Simulation(DynamicWindow):
 
         # Draw on left mouse button press
         if mouse_buttons[0]:
-            pygame.draw.circle(self.draw_canvas, draw_color, mouse_pos, draw_radius)
+            drawn = pygame.draw.circle(self.draw_canvas, draw_color, mouse_pos, draw_radius)
             # Fill gap between this frame and the last frame
             if self.last_draw_pos:
-                pygame.draw.line(self.draw_canvas, draw_color, self.last_draw_pos, mouse_pos, 2*draw_radius)
+                drawn.union_ip(pygame.draw.line(self.draw_canvas, draw_color, self.last_draw_pos, mouse_pos,
+                                                2*draw_radius))
             self.last_draw_pos = mouse_pos
+            self.incremental_build.markDirty(self.draw_canvas, drawn)
 
         # Render the draw canvas and the draw state/draw cursor
         screen.blit(self.draw_canvas, (0,0))
         self.draw_state.render(screen)
 
-    def renderSimulateMode(self, screen):
-        self.simulation_state.render(screen)
+    def renderSimulateMode(self, screen) -> list:
+        if self.simulation_thread is None:
+            return self.simulation_state.render(screen)
+        # Never wait for the simulation thread, draw the latest step it has finished
+        snapshot = self.simulation_thread.snapshots.read()
+        if snapshot is None:
+            return [screen.get_rect()]
+        return self.simulation_state.renderSnapshot(screen, snapshot)
+
+    def startSimulationThread(self):
+        self.simulation_thread = SimulationThread(self.simulation_state, Simulation.PHYSICS_DT, Simulation.MAX_SUBSTEPS)
+        self.simulation_thread.start()
+
+    def latestPositions(self):
+        '''Store-wide particle positions of the latest finished physics step.'''
+        if self.simulation_thread is not None:
+            snapshot = self.simulation_thread.snapshots.read()
+            return None if snapshot is None else snapshot.positions()
+        store = self.simulation_state.world.particles
+        return store.pos[:store.count]
+
+    def toggleRecording(self):
+        if self.recorder is None:
+            # The simulation thread rewrites the bonds as it despawns, so record from its latest step
+            snapshot = None
+            if self.simulation_thread is not None:
+                snapshot = self.simulation_thread.snapshots.read()
+                if snapshot is None:
+                    return
+            self.recorder = Recorder(Simulation.RECORDING_PATH, self.simulation_state, self.resolution,
+                                     Simulation.RECORDING_ENCODING, snapshot=snapshot)
+        else:
+            self.recorder.close()
+            self.recorder = None
+
+    def stopSimulationThread(self):
+        if self.simulation_thread is not None:
+            self.simulation_thread.stop()
+            self.simulation_thread = None
+
+    def spawnParticles(self, positions, velocities, mass):
+        '''Adds free particles to the running simulation, through the simulation
+        thread's command channel when there is one.'''
+        if self.simulation_thread is not None:
+            self.simulation_thread.send(SimulationThread.SPAWN, positions, velocities, mass)
+        else:
+            self.simulation_state.spawn(positions, velocities, mass)
 
     def render(self, screen, res):
+        # Draw mode repaints the whole canvas, so it updates the whole display
+        dirty_rects = None
         match self.mode:
             case Simulation.MODE_DRAW:
                 self.renderDrawMode(screen)
             case Simulation.MODE_SIMULATE:
-                self.renderSimulateMode(screen)
+                dirty_rects = self.renderSimulateMode(screen)
+
+        if self.show_profiler:
+            overlay_rect = profiler.render(screen)
+            if dirty_rects is not None:
+                dirty_rects.append(overlay_rect)
+        return dirty_rects
 
     def update(self, dt, events):
         # Reset dt when simulation mode starts
@@ -181,31 +471,65 @@ class Simulation(DynamicWindow):
                     match self.mode:
                         case Simulation.MODE_DRAW:
                             # Generate softbodies and staticbodies and switch to simulation mode
-                            self.simulation_state = SimulationState.fromCanvas(self.draw_canvas, 
-                                                                            BrushColors.softbody, 
-                                                                            BrushColors.staticbody, 
-                                                                            Simulation.EDGE_LENGTH,
-                                                                            Simulation.BUILD_VOXEL_SIZE,
-                                                                            Simulation.PARTICLE_MASS,
-                                                                            Simulation.SPRING_K)
-                            
+                            self.simulation_state.close()
+                            with profiler.section('build'):
+                                scene = self.build_cache.build(self.draw_canvas, 
+                                                               BrushColors.softbody, 
+                                                               BrushColors.staticbody, 
+                                                               Simulation.EDGE_TOLERANCE,
+                                                               Simulation.BUILD_VOXEL_SIZE,
+                                                               Simulation.PARTICLE_MASS,
+                                                               Simulation.SPRING_K,
+                                                               Simulation.MAX_CELL_SIZE,
+                                                               self.incremental_build.scene)
+                                self.simulation_state = SimulationState.fromScene(scene)
+                                if Simulation.PHYSICS_SOLVER == 'xpbd':
+                                    self.simulation_state.solver = XPBDSolver(Simulation.XPBD_ITERATIONS)
+                                if Simulation.STATIC_COLLISION == 'sdf':
+                                    if scene.distance_field is None:
+                                        scene.distance_field = DistanceField.fromCanvas(self.draw_canvas,
+                                                                                        BrushColors.staticbody)
+                                    self.simulation_state.distance_field = scene.distance_field
+                                self.simulation_state.bounds = Rect((0, 0), self.resolution).inflate(
+                                    2*Simulation.DESPAWN_MARGIN, 2*Simulation.DESPAWN_MARGIN)
+                                self.simulation_state.useWorkers(Simulation.PHYSICS_WORKERS)
+
                             # Switch to simulate mode
                             self.mode = Simulation.MODE_SIMULATE
                             self.simulation_start = True
+                            self.physics_clock.reset()
+                            if Simulation.PHYSICS_THREAD:
+                                self.startSimulationThread()
                         case Simulation.MODE_SIMULATE:
+                            self.stopSimulationThread()
+                            if self.recorder is not None:
+                                self.toggleRecording()
                             self.mode = Simulation.MODE_DRAW
+                if event.key == pygame.K_F3:
+                    self.show_profiler = not self.show_profiler
+                if event.key == pygame.K_r and self.mode == Simulation.MODE_SIMULATE:
+                    self.toggleRecording()
+                if event.key == pygame.K_F4:
+                    profiler.dumpChromeTrace(Simulation.PROFILE_TRACE_PATH)
+                    profiler.dumpCSV(Simulation.PROFILE_CSV_PATH)
                 if event.key == pygame.K_SPACE:
-                    for angle in range(0, 360, 20):
-                        pos = Vector2(mouse.get_pos()[0], mouse.get_pos()[1])
-                        vel = Vector2.from_polar((20, angle))
-                        self.test_particles.append(Particle(pos, vel, 10))
+                    if self.mode == Simulation.MODE_SIMULATE:
+                        # Spawn a ring of particles flying out from the mouse
+                        angles = np.radians(np.arange(0, 360, 20))
+                        velocities = 20 * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+                        self.spawnParticles(np.tile(mouse.get_pos(), (len(angles), 1)), velocities, 10)
 
         match self.mode:
             case Simulation.MODE_DRAW:
                 self.updateDrawMode(dt, events)
             case Simulation.MODE_SIMULATE:
                 self.updateSimulateMode(dt, events)
+                if self.recorder is not None:
+                    positions = self.latestPositions()
+                    if positions is not None:
+                        self.recorder.capture(positions)
 
 
-sim = Simulation((800, 600), (10, 10, 15))
-sim.start()
\ No newline at end of file
+if __name__ == '__main__':
+    sim = Simulation((800, 600), (10, 10, 15))
+    sim.start()
@@ -0,0 +1,312 @@
+from multiprocessing import get_context, shared_memory
+import pickle
+import numpy as np
+from particle_array import ParticleArray
+from spring_array import SpringArray
+
+PARTICLE_FIELDS = ('pos', 'prev_pos', 'vel', 'accel', 'force', 'mass')
+SPRING_FIELDS = ('i1', 'i2', 'rest_length', 'k')
+
+class SharedArrays:
+    '''NumPy arrays backed by named shared memory blocks, so that worker processes
+    can attach to the same data by name instead of having it pickled to them.'''
+
+    def __init__(self):
+        self.blocks = {}
+        self.arrays = {}
+
+    def create(self, name: str, shape, dtype) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self.blocks[name] = block
+        self.arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+        return self.arrays[name]
+
+    def spec(self) -> dict:
+        '''Everything needed to attach to the arrays from another process.'''
+        return {name: (self.blocks[name].name, array.shape, array.dtype.str) for name, array in self.arrays.items()}
+
+    @staticmethod
+    def attach(spec: dict):
+        shared = SharedArrays()
+        for name, (block_name, shape, dtype) in spec.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            shared.blocks[name] = block
+            shared.arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+        return shared
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if unlink:
+                block.unlink()
+        self.blocks = {}
+
+
+'''Worker side. Each worker attaches to the shared arrays when it first needs them, and
+again whenever the stepper has moved them (see ParallelStepper._publish). Every task
+only receives a few integers.'''
+
+_control = None
+_generation = -1
+_shared = None
+_staticbodies = None
+_gravity = None
+
+def _initWorker(control_name, staticbodies, gravity):
+    global _control, _staticbodies, _gravity
+    _control = shared_memory.SharedMemory(name=control_name)
+    _staticbodies = staticbodies
+    _gravity = np.array(gravity, dtype=float)
+
+def _arrays() -> dict:
+    '''The shared arrays, reattached if the stepper has published new ones since.'''
+    global _generation, _shared
+    generation, size = np.ndarray((2,), np.int64, buffer=_control.buf)
+    if generation != _generation:
+        if _shared is not None:
+            _shared.close()
+        _shared = SharedArrays.attach(pickle.loads(_control.buf[16:16 + size]))
+        _generation = generation
+    return _shared.arrays
+
+def _solveSprings(start, stop):
+    '''Spring and damping force of a range of bonds, written to each bond's own row
+    of bond_force rather than onto the particles.'''
+    a = _arrays()
+    i1, i2 = a['i1'][start:stop], a['i2'][start:stop]
+    spring_vecs = a['pos'][i2] - a['pos'][i1]
+    lengths = np.sqrt(np.einsum('ij,ij->i', spring_vecs, spring_vecs))
+    stretched = lengths != 0
+    directions = np.zeros_like(spring_vecs)
+    directions[stretched] = spring_vecs[stretched] / lengths[stretched, None]
+    resistance = a['k'][start:stop] * (lengths - a['rest_length'][start:stop])
+    damping = np.einsum('ij,ij->i', directions, a['vel'][i2] - a['vel'][i1]) * SpringArray.DAMPING
+    a['bond_force'][start:stop] = np.where(stretched, resistance + damping, 0)[:, None] * directions
+
+def _integrate(start, stop, dt):
+    '''Sums the bond forces on a range of particles, always in bond order, adds gravity
+    and integrates the active ones.'''
+    a = _arrays()
+    a['prev_pos'][start:stop] = a['pos'][start:stop]
+    first, last = a['incident_starts'][start], a['incident_starts'][stop]
+    if last > first:
+        contributions = a['bond_force'][a['incident_bonds'][first:last]] * a['incident_signs'][first:last, None]
+        owners = np.repeat(np.arange(stop - start), np.diff(a['incident_starts'][start:stop + 1]))
+        for axis in range(2):
+            a['force'][start:stop, axis] += np.bincount(owners, contributions[:, axis], stop - start)
+
+    active = start + np.flatnonzero(a['active'][start:stop])
+    a['force'][active] += a['mass'][active, None] * _gravity
+    a['accel'][active] = a['force'][active] / a['mass'][active, None]
+    a['vel'][active] += a['accel'][active] * dt
+    a['pos'][active] += a['vel'][active] * dt
+    a['force'][active] = 0
+
+def _collideTile(tile, tile_x, tile_y, span_y, tile_count, tile_size):
+    '''Runs the sequential collision pass for the active particles of one tile. Its
+    halo, the particles of the neighbouring tiles within reach, can be pushed but does
+    not push.'''
+    a = _arrays()
+    tile_keys, tile_starts, order = a['tile_keys'][:tile_count], a['tile_starts'], a['tile_order']
+    neighbours = [(tile_x + dx) * span_y + tile_y + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                  if 0 <= tile_y + dy < span_y]
+    slots = np.searchsorted(tile_keys, neighbours)
+    slots = slots[(slots < tile_count) & (tile_keys[np.minimum(slots, tile_count - 1)] == neighbours)]
+    candidates = np.sort(np.concatenate([order[tile_starts[slot]:tile_starts[slot + 1]] for slot in slots]))
+
+    # Keep only the halo particles close enough to be reached from inside the tile
+    low = (np.array([tile_x, tile_y]) + a['tile_origin']) * tile_size - ParallelStepper.HALO
+    high = low + tile_size + 2 * ParallelStepper.HALO
+    pos = a['pos'][candidates]
+    candidates = candidates[((pos >= low) & (pos < high)).all(axis=1)]
+
+    own = order[tile_starts[tile]:tile_starts[tile + 1]]
+    pushers = np.flatnonzero(np.isin(candidates, own) & a['active'][candidates])
+    local = ParticleArray(len(candidates))
+    local.addMany(a['pos'][candidates], a['vel'][candidates], a['mass'][candidates])
+    local.resolveCollisions(pushers)
+    a['pos'][candidates] = local.pos[:local.count]
+    a['vel'][candidates] = local.vel[:local.count]
+
+def _collideStatic(start, stop, dt):
+    a = _arrays()
+    active = start + np.flatnonzero(a['active'][start:stop])
+    pos, vel, prev_pos = a['pos'][active], a['vel'][active], a['prev_pos'][active]
+    for staticbody in _staticbodies:
+        staticbody.collide(pos, vel, dt, prev_pos)
+    a['pos'][active], a['vel'][active] = pos, vel
+
+
+class ParallelStepper:
+    '''Steps a ParticleArray and SpringArray on a pool of worker processes.
+
+    The store's arrays are moved into shared memory, so each phase only sends ranges
+    or tile numbers to the workers:
+        - springs: ranges of bonds; each bond's force goes to its own row.
+        - integrate: ranges of particles; each particle sums its bond forces in bond
+          order, so the result does not depend on how work was split.
+        - collisions: square tiles with halos, in four passes where no two tiles of
+          a pass are adjacent, so concurrent tiles never touch the same particles.
+        - staticbodies: ranges of particles.
+    The result is deterministic for any number of workers. Collisions are resolved
+    tile by tile rather than in global index order, so it is not identical to the
+    single-process step.'''
+
+    TILE_SIZE = 160 # Larger tiles have less overhead, smaller ones spread over more workers
+    HALO = 2 * ParticleArray.CONTACT_RADIUS # Reach of the pushes made from inside a tile
+    CHUNKS_PER_WORKER = 4
+    CONTROL_SIZE = 1 << 16 # Bytes for the pickled spec of the shared arrays, a few kilobytes
+
+    def __init__(self, particles: ParticleArray, springs: SpringArray, indices, staticbodies, gravity, workers: int,
+                 tile_size=TILE_SIZE):
+        self.particles = particles
+        self.springs = springs
+        self.indices = np.asarray(indices, dtype=int)
+        # Anything that collides like StaticBody.collide, e.g. a DistanceField
+        self.staticbodies = staticbodies
+        self.gravity = gravity
+        self.workers = workers
+        self.tile_size = tile_size
+        self.shared = None
+        # Where the workers find the shared arrays: a generation number, the size of
+        # the pickled spec and the spec itself
+        self.control = shared_memory.SharedMemory(create=True, size=ParallelStepper.CONTROL_SIZE)
+        self._generation = 0
+        self._share()
+        self.pool = get_context('spawn').Pool(self.workers, _initWorker,
+                                              (self.control.name, self.staticbodies, self.gravity))
+
+    def _share(self):
+        '''Moves the stores' arrays into new shared memory, sized to their current
+        capacities, and tells the workers where to find them. The pool keeps running;
+        this only happens again when a store outgrows its arrays.'''
+        particles, springs = self.particles, self.springs
+        old_shared, self.shared = self.shared, SharedArrays()
+        for field in PARTICLE_FIELDS:
+            array = getattr(particles, field)
+            shared_array = self.shared.create(field, array.shape, array.dtype)
+            shared_array[:] = array
+            setattr(particles, field, shared_array)
+        capacity = len(particles.mass)
+        active = self.shared.create('active', (capacity,), bool)
+        active[:] = False
+        active[self.indices] = True
+
+        for field in SPRING_FIELDS:
+            array = getattr(springs, field)
+            shared_array = self.shared.create(field, array.shape, array.dtype)
+            shared_array[:] = array
+            setattr(springs, field, shared_array)
+        bond_capacity = len(springs.k)
+        self.shared.create('bond_force', (bond_capacity, 2), float)
+        self.shared.create('incident_bonds', (2 * bond_capacity,), np.int64)
+        self.shared.create('incident_signs', (2 * bond_capacity,), float)
+        self.shared.create('incident_starts', (capacity + 1,), np.int64)
+        self._indexBonds()
+
+        self.shared.create('tile_order', (capacity,), np.int64)
+        self.shared.create('tile_keys', (capacity,), np.int64)
+        self.shared.create('tile_starts', (capacity + 1,), np.int64)
+        self.shared.create('tile_origin', (2,), np.int64)
+
+        self._publish()
+        if old_shared is not None:
+            old_shared.close(unlink=True)
+
+    def _indexBonds(self):
+        '''Lists the bonds touching each particle, as +1 on the first particle and -1 on
+        the second, in the shared arrays.'''
+        springs, a = self.springs, self.shared.arrays
+        bonds = springs.count
+        ends = np.concatenate([springs.i1[:bonds], springs.i2[:bonds]])
+        order = np.lexsort((np.tile(np.arange(bonds), 2), ends))
+        a['incident_bonds'][:2 * bonds] = np.tile(np.arange(bonds), 2)[order]
+        a['incident_signs'][:2 * bonds] = np.repeat([1.0, -1.0], bonds)[order]
+        a['incident_starts'][:] = np.searchsorted(ends[order], np.arange(len(a['incident_starts'])))
+        self._topology_version = springs.topology_version
+
+    def _publish(self):
+        '''Writes the spec of the current shared arrays to the control block. Workers
+        compare its generation with their own before every task, and reattach when it
+        has changed. The pool is idle between steps, so none of them reads it while it
+        is written.'''
+        spec = pickle.dumps(self.shared.spec())
+        if 16 + len(spec) > ParallelStepper.CONTROL_SIZE:
+            raise ValueError(f'Shared array spec of {len(spec)} bytes does not fit the control block')
+        self._generation += 1
+        self.control.buf[16:16 + len(spec)] = spec
+        np.ndarray((2,), np.int64, buffer=self.control.buf)[:] = (self._generation, len(spec))
+
+    def setIndices(self, indices):
+        '''Changes which particles are stepped.'''
+        self.indices = np.asarray(indices, dtype=int)
+        # A store that has outgrown its shared arrays is reshared, with these indices, on the next step
+        if self.shared is not None and self.particles.pos is self.shared.arrays['pos']:
+            active = self.shared.arrays['active']
+            active[:] = False
+            active[self.indices] = True
+
+    def _chunks(self, count) -> list:
+        bounds = np.linspace(0, count, self.workers * ParallelStepper.CHUNKS_PER_WORKER + 1).astype(int)
+        return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+    def _buildTiles(self) -> tuple:
+        '''Sorts the particles by tile. Returns each tile's coordinates and the number
+        of rows in a column of tiles.'''
+        a = self.shared.arrays
+        count = self.particles.count
+        tiles = np.floor(a['pos'][:count] / self.tile_size).astype(np.int64)
+        origin = tiles.min(axis=0)
+        tiles -= origin
+        span_y = int(tiles[:, 1].max()) + 1
+        keys = tiles[:, 0] * span_y + tiles[:, 1]
+        order = np.argsort(keys, kind='stable')
+        tile_keys, tile_starts = np.unique(keys[order], return_index=True)
+        a['tile_origin'][:] = origin
+        a['tile_order'][:count] = order
+        a['tile_keys'][:len(tile_keys)] = tile_keys
+        a['tile_starts'][:len(tile_keys)] = tile_starts
+        a['tile_starts'][len(tile_keys)] = count
+        return (np.stack([tile_keys // span_y, tile_keys % span_y], axis=1), span_y)
+
+    def step(self, dt):
+        particles, springs = self.particles, self.springs
+        # Reshare if either store has grown, and so been reallocated, since the last step
+        if particles.pos is not self.shared.arrays['pos'] or springs.k is not self.shared.arrays['k']:
+            self._share()
+        elif springs.topology_version != self._topology_version:
+            self._indexBonds()
+        count = particles.count
+        if count == 0:
+            return
+
+        self.pool.starmap(_solveSprings, self._chunks(springs.count))
+        self.pool.starmap(_integrate, [(start, stop, dt) for start, stop in self._chunks(count)])
+
+        tiles, span_y = self._buildTiles()
+        colors = (tiles[:, 0] % 2) * 2 + tiles[:, 1] % 2
+        for color in range(4):
+            self.pool.starmap(_collideTile, [(int(tile), int(tiles[tile, 0]), int(tiles[tile, 1]), span_y, len(tiles),
+                                              self.tile_size) for tile in np.flatnonzero(colors == color)])
+
+        self.pool.starmap(_collideStatic, [(start, stop, dt) for start, stop in self._chunks(count)])
+
+    def close(self):
+        '''Stops the pool and moves the stores' arrays back out of shared memory.'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.shared is not None:
+            for field in PARTICLE_FIELDS:
+                setattr(self.particles, field, np.array(getattr(self.particles, field)))
+            for field in SPRING_FIELDS:
+                setattr(self.springs, field, np.array(getattr(self.springs, field)))
+            self.shared.close(unlink=True)
+            self.shared = None
+        if self.control is not None:
+            self.control.close()
+            self.control.unlink()
+            self.control = None
@@ -1,50 +1,70 @@
 from dynamic_object import Renderable, Updatable
+from particle_array import ParticleArray
 from pygame import Vector2, draw
-from math import sqrt
+from batch_render import drawDots
 
 class Particle(Renderable, Updatable):
+    '''Thin view onto a single row of a ParticleArray.'''
 
     RENDER = True
     RENDER_RADIUS = 2
     RENDER_COLOR = (150, 160, 20)
 
-    particles = []
+    def __init__(self, pos: Vector2, vel: Vector2, mass: float, store: ParticleArray):
+        self.store = store
+        self.index = self.store.add((pos[0], pos[1]), (vel[0], vel[1]), mass)
 
-    def __init__(self, pos: Vector2, vel: Vector2, mass: float):
-        self.pos = pos
-        self.vel = vel
-        self.accel = Vector2(0,0)
-        self.mass = mass
+    @staticmethod
+    def fromIndices(store: ParticleArray, indices) -> list:
+        '''Creates views onto particles that were added to the store in bulk.'''
+        particles = []
+        for index in indices:
+            particle = Particle.__new__(Particle)
+            particle.store = store
+            particle.index = int(index)
+            particles.append(particle)
+        return particles
 
-        self._net_force = Vector2(0,0)
+    @property
+    def pos(self) -> Vector2:
+        return Vector2(*self.store.pos[self.index])
 
-        Particle.particles.append(self)
+    @pos.setter
+    def pos(self, value):
+        self.store.pos[self.index] = (value[0], value[1])
+
+    @property
+    def vel(self) -> Vector2:
+        return Vector2(*self.store.vel[self.index])
+
+    @vel.setter
+    def vel(self, value):
+        self.store.vel[self.index] = (value[0], value[1])
+
+    @property
+    def accel(self) -> Vector2:
+        return Vector2(*self.store.accel[self.index])
+
+    @property
+    def mass(self) -> float:
+        return self.store.mass[self.index]
+
+    @mass.setter
+    def mass(self, value):
+        self.store.mass[self.index] = value
 
     def applyForce(self, force: Vector2):
-        self._net_force += force
-    
+        self.store.force[self.index] += (force[0], force[1])
+
+    @staticmethod
+    def renderMany(screen, positions):
+        '''Draws a particle at each of an N×2 array of positions in one pass.'''
+        if not Particle.RENDER: return
+        drawDots(screen, positions, Particle.RENDER_COLOR, Particle.RENDER_RADIUS)
+
     def render(self, screen):
         if not Particle.RENDER: return
-        draw.circle(screen, Particle.RENDER_COLOR, (self.pos.x, self.pos.y), Particle.RENDER_RADIUS)
+        draw.circle(screen, Particle.RENDER_COLOR, self.store.renderPosition(self.index), Particle.RENDER_RADIUS)
 
     def update(self, dt):
-        self.accel = self._net_force / self.mass
-        # Eulers integration
-        self.vel += self.accel * dt
-        self.pos += self.vel * dt
-
-        for particle in Particle.particles:
-            if particle == self:
-                continue
-            squared_dist = (particle.pos - self.pos).magnitude_squared()
-            if squared_dist == 0:
-                continue
-            if squared_dist <= 5**2:
-                push_normal = (particle.pos - self.pos).normalize();
-                dist = sqrt(squared_dist)
-                delta = 5 - dist
-                particle.pos += delta * push_normal
-                particle.vel = particle.vel.reflect(push_normal)
-
-        # Reset net force for next iteration
-        self._net_force = Vector2(0,0)
\ No newline at end of file
+        self.store.step(dt, [self.index])
@@ -0,0 +1,188 @@
+import numpy as np
+from math import sqrt, floor
+from spatial_hash import SpatialHash
+
+class ParticleArray:
+    '''Structure-of-arrays particle store. Positions, velocities, forces and masses
+    live in contiguous NumPy arrays so that every particle can be stepped at once.
+    Rows are addressed by index; the arrays may be reallocated when the store grows,
+    so hold on to indices rather than slices of the arrays.'''
+
+    CONTACT_RADIUS = 5
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.count = 0
+        self._allocate(max(1, capacity))
+        self.broadphase = SpatialHash(ParticleArray.CONTACT_RADIUS)
+        # Blend between the positions before and after the last step used for rendering
+        self.render_alpha = 1
+
+    def _allocate(self, capacity):
+        self.pos = np.zeros((capacity, 2))
+        self.prev_pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.accel = np.zeros((capacity, 2))
+        self.force = np.zeros((capacity, 2))
+        self.mass = np.ones(capacity)
+
+    def _grow(self, min_capacity):
+        capacity = len(self.mass)
+        if min_capacity <= capacity:
+            return
+        while capacity < min_capacity:
+            capacity *= 2
+        old = (self.pos, self.prev_pos, self.vel, self.accel, self.force, self.mass)
+        self._allocate(capacity)
+        for new_array, old_array in zip((self.pos, self.prev_pos, self.vel, self.accel, self.force, self.mass), old):
+            new_array[:self.count] = old_array[:self.count]
+
+    def add(self, pos, vel, mass) -> int:
+        '''Adds a single particle and returns its index.'''
+        return int(self.addMany([pos], [vel], [mass])[0])
+
+    def addMany(self, pos, vel, mass) -> np.ndarray:
+        '''Adds a batch of particles and returns their indices.'''
+        pos = np.asarray(pos, dtype=float).reshape(-1, 2)
+        n = len(pos)
+        self._grow(self.count + n)
+        indices = np.arange(self.count, self.count + n)
+        self.count += n
+        self.setMany(indices, pos, vel, mass)
+        return indices
+
+    def setMany(self, indices, pos, vel, mass):
+        '''Overwrites existing rows with new particles at rest.'''
+        pos = np.asarray(pos, dtype=float).reshape(-1, 2)
+        self.pos[indices] = pos
+        self.prev_pos[indices] = pos
+        self.vel[indices] = np.asarray(vel, dtype=float).reshape(-1, 2)
+        self.mass[indices] = mass
+        self.accel[indices] = 0
+        self.force[indices] = 0
+
+    def keep(self, indices):
+        '''Packs the given rows, in order, to the front of the store and drops the rest.'''
+        indices = np.asarray(indices, dtype=int)
+        for array in (self.pos, self.prev_pos, self.vel, self.accel, self.force, self.mass):
+            array[:len(indices)] = array[indices]
+        self.count = len(indices)
+
+    def _indices(self, indices):
+        if indices is None:
+            return np.arange(self.count)
+        return np.asarray(indices, dtype=int)
+
+    def applyForces(self, indices, forces):
+        '''Accumulates forces onto the given particles. Repeated indices are summed.'''
+        np.add.at(self.force, self._indices(indices), forces)
+
+    def integrate(self, dt, indices=None):
+        '''Semi-implicit Euler-integrates the given particles (all by default) and resets
+        their net force. Velocity is updated first and then moves the particle.'''
+        indices = self._indices(indices)
+        self.accel[indices] = self.force[indices] / self.mass[indices, None]
+        self.vel[indices] += self.accel[indices] * dt
+        self.pos[indices] += self.vel[indices] * dt
+        self.force[indices] = 0
+
+    def pushNeighbours(self, index):
+        '''Pushes every particle within contact range of the given particle out
+        to the contact radius and reflects its velocity about the push normal.'''
+        pos = self.pos[:self.count]
+        vel = self.vel[:self.count]
+        offsets = pos - pos[index]
+        squared_dists = np.einsum('ij,ij->i', offsets, offsets)
+        hits = np.flatnonzero((squared_dists <= ParticleArray.CONTACT_RADIUS**2) & (squared_dists != 0))
+        if len(hits) == 0:
+            return
+        dists = np.sqrt(squared_dists[hits])
+        normals = offsets[hits] / dists[:, None]
+        pos[hits] += (ParticleArray.CONTACT_RADIUS - dists)[:, None] * normals
+        vel_dot_n = np.einsum('ij,ij->i', vel[hits], normals)
+        vel[hits] -= 2 * vel_dot_n[:, None] * normals
+
+    def resolveCollisions(self, indices=None, built=False):
+        '''Lets each of the given particles push its neighbours, in order, giving the
+        same result as calling pushNeighbours for each of them. A spatial hash finds
+        the first particle that is in contact with anything; no state changes before
+        it, so only the particles from there on are resolved sequentially. If built,
+        the broadphase is already built over the current positions.'''
+        indices = self._indices(indices)
+        if len(indices) == 0:
+            return
+        if not built:
+            self.broadphase.build(self.pos[:self.count])
+        pair_i, _ = self.broadphase.contactPairs(ParticleArray.CONTACT_RADIUS, indices)
+        if len(pair_i) == 0:
+            return
+        rank = np.full(self.count, len(indices))
+        rank[indices] = np.arange(len(indices))
+        first = rank[pair_i].min()
+        self._resolveSequentially(indices[first:])
+
+    def _resolveSequentially(self, indices):
+        '''Gauss-Seidel collision pass over a uniform grid of contact-radius-sized
+        cells. Pushed particles are moved between cells as they go, so pushes made
+        earlier in the pass are seen by later particles.'''
+        radius = ParticleArray.CONTACT_RADIUS
+        count = self.count
+        # Plain lists are much faster than NumPy scalars for element-wise access
+        pos_x, pos_y = self.pos[:count, 0].tolist(), self.pos[:count, 1].tolist()
+        vel_x, vel_y = self.vel[:count, 0].tolist(), self.vel[:count, 1].tolist()
+        cells = np.floor(self.pos[:count] / radius).astype(np.int64)
+        cell_x, cell_y = cells[:, 0].tolist(), cells[:, 1].tolist()
+
+        grid = {}
+        for index, cell in enumerate(zip(cell_x, cell_y)):
+            grid.setdefault(cell, []).append(index)
+
+        for i in indices.tolist():
+            cx, cy, xi, yi = cell_x[i], cell_y[i], pos_x[i], pos_y[i]
+            candidates = []
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    candidates.extend(grid.get((cx + dx, cy + dy), ()))
+
+            for j in candidates:
+                dx = pos_x[j] - xi
+                dy = pos_y[j] - yi
+                squared_dist = dx*dx + dy*dy
+                if squared_dist == 0 or squared_dist > radius**2:
+                    continue
+                dist = sqrt(squared_dist)
+                nx, ny = dx / dist, dy / dist
+                pos_x[j] += (radius - dist) * nx
+                pos_y[j] += (radius - dist) * ny
+                vel_dot_n = vel_x[j]*nx + vel_y[j]*ny
+                vel_x[j] -= 2 * vel_dot_n * nx
+                vel_y[j] -= 2 * vel_dot_n * ny
+                # Move the pushed particle to its new cell
+                new_cell = (floor(pos_x[j] / radius), floor(pos_y[j] / radius))
+                if new_cell != (cell_x[j], cell_y[j]):
+                    grid[(cell_x[j], cell_y[j])].remove(j)
+                    grid.setdefault(new_cell, []).append(j)
+                    cell_x[j], cell_y[j] = new_cell
+
+        self.pos[:count, 0], self.pos[:count, 1] = pos_x, pos_y
+        self.vel[:count, 0], self.vel[:count, 1] = vel_x, vel_y
+
+    def savePositions(self):
+        '''Remembers the current positions as the start of the next step.'''
+        self.prev_pos[:self.count] = self.pos[:self.count]
+
+    def renderPositions(self) -> np.ndarray:
+        '''Positions to draw, interpolated render_alpha of the way through the last step.'''
+        prev_pos, pos = self.prev_pos[:self.count], self.pos[:self.count]
+        if self.render_alpha == 1:
+            return pos
+        return prev_pos + (pos - prev_pos) * self.render_alpha
+
+    def renderPosition(self, index) -> np.ndarray:
+        '''Interpolated position of a single particle (see renderPositions).'''
+        return self.prev_pos[index] + (self.pos[index] - self.prev_pos[index]) * self.render_alpha
+
+    def step(self, dt, indices=None):
+        self.savePositions()
+        self.integrate(dt, indices)
+        self.resolveCollisions(indices)
@@ -0,0 +1,30 @@
+class PhysicsClock:
+    '''Turns variable frame times into a whole number of fixed physics steps. Leftover
+    time is carried over to the next frame, and alpha says how far the simulation is
+    into the next, not yet taken, step so rendering can interpolate between states.'''
+
+    def __init__(self, fixed_dt: float, max_substeps: int):
+        self.fixed_dt = fixed_dt
+        self.max_substeps = max_substeps
+        self.reset()
+
+    def reset(self):
+        self.accumulator = 0
+        self.dropped_time = 0
+
+    def advance(self, frame_dt: float) -> int:
+        '''Adds a frame's worth of time and returns the number of fixed steps to take.
+        Time beyond max_substeps steps is dropped so that a slow frame slows the
+        simulation down instead of making every following frame slower still.'''
+        self.accumulator += frame_dt
+        steps = int(self.accumulator / self.fixed_dt)
+        if steps > self.max_substeps:
+            self.dropped_time += (steps - self.max_substeps) * self.fixed_dt
+            self.accumulator -= (steps - self.max_substeps) * self.fixed_dt
+            steps = self.max_substeps
+        self.accumulator -= steps * self.fixed_dt
+        return steps
+
+    @property
+    def alpha(self) -> float:
+        return self.accumulator / self.fixed_dt
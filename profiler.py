@@ -0,0 +1,146 @@
+from dynamic_object import Renderable
+from time import perf_counter
+from threading import Lock
+import json
+import numpy as np
+import pygame
+
+class _Section:
+    '''Context manager that times one run of a phase.'''
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = perf_counter()
+
+    def __exit__(self, *exception):
+        self.profiler.record(self.name, self.start_time, perf_counter() - self.start_time)
+
+
+class _NoSection:
+
+    def __enter__(self): pass
+
+    def __exit__(self, *exception): pass
+
+
+class PhaseHistory:
+    '''Fixed-size ring buffer of the start times and durations of one phase.'''
+
+    def __init__(self, size):
+        self.starts = np.zeros(size)
+        self.durations = np.zeros(size)
+        self.next = 0
+        self.count = 0
+
+    def add(self, start_time, duration):
+        self.starts[self.next] = start_time
+        self.durations[self.next] = duration
+        self.next = (self.next + 1) % len(self.durations)
+        self.count = min(self.count + 1, len(self.durations))
+
+    def recent(self) -> tuple[np.ndarray, np.ndarray]:
+        '''Start times and durations, oldest first.'''
+        order = np.arange(self.next - self.count, self.next) % len(self.durations)
+        return (self.starts[order], self.durations[order])
+
+
+class Profiler(Renderable):
+    '''Times named phases of the frame into ring buffers. Shows rolling statistics
+    as an overlay and dumps the buffers as a Chrome trace or CSV. Phases can be
+    recorded from any thread (e.g. a SimulationThread) while another reads them.'''
+
+    HISTORY = 600 # Samples kept per phase
+
+    OVERLAY_COLOR = (230, 230, 230)
+    OVERLAY_BG_COLOR = (0, 0, 0, 170)
+    OVERLAY_FONT_SIZE = 18
+    OVERLAY_POS = (8, 8)
+
+    def __init__(self, history=HISTORY):
+        self.history = history
+        self.enabled = True
+        self.phases = {}
+        # Held while the phases are changed or read
+        self._lock = Lock()
+        self._font = None
+        self._no_section = _NoSection()
+        self._origin = perf_counter()
+
+    def section(self, name: str):
+        '''Times the body of a with-block as one run of the named phase.'''
+        if not self.enabled:
+            return self._no_section
+        return _Section(self, name)
+
+    def record(self, name: str, start_time: float, duration: float):
+        with self._lock:
+            if name not in self.phases:
+                self.phases[name] = PhaseHistory(self.history)
+            self.phases[name].add(start_time, duration)
+
+    def clear(self):
+        with self._lock:
+            self.phases = {}
+
+    def _recent(self) -> dict:
+        '''Copies of the start times and durations of every phase, oldest first.'''
+        with self._lock:
+            return {name: phase.recent() for name, phase in self.phases.items()}
+
+    def summary(self) -> dict:
+        '''Mean, median, 95th and 99th percentile duration of every phase, in seconds.'''
+        summary = {}
+        for name, (_, durations) in self._recent().items():
+            p50, p95, p99 = np.percentile(durations, (50, 95, 99))
+            summary[name] = {'mean': durations.mean(), 'p50': p50, 'p95': p95, 'p99': p99,
+                             'samples': len(durations)}
+        return summary
+
+    def render(self, screen) -> pygame.Rect:
+        '''Draws the overlay and returns the area it covers.'''
+        if self._font is None:
+            pygame.font.init()
+            self._font = pygame.font.Font(None, Profiler.OVERLAY_FONT_SIZE)
+
+        lines = [f'{"phase":<24}{"mean":>8}{"p50":>8}{"p95":>8}{"p99":>8}  ms']
+        for name, stats in sorted(self.summary().items()):
+            lines.append(f'{name:<24}' + ''.join(f'{1000*stats[key]:>8.2f}' for key in ('mean', 'p50', 'p95', 'p99')))
+        rendered = [self._font.render(line, True, Profiler.OVERLAY_COLOR) for line in lines]
+
+        line_height = self._font.get_linesize()
+        background = pygame.Surface((max(text.get_width() for text in rendered) + 8, line_height * len(rendered) + 8),
+                                    pygame.SRCALPHA)
+        background.fill(Profiler.OVERLAY_BG_COLOR)
+        x, y = Profiler.OVERLAY_POS
+        overlay_rect = screen.blit(background, (x - 4, y - 4))
+        for i, text in enumerate(rendered):
+            screen.blit(text, (x, y + i * line_height))
+        return overlay_rect
+
+    def _events(self):
+        '''Every recorded run as (start, duration, name), oldest first.'''
+        events = []
+        for name, (starts, durations) in self._recent().items():
+            events += zip(starts.tolist(), durations.tolist(), [name] * len(starts))
+        return sorted(events)
+
+    def dumpChromeTrace(self, path: str):
+        '''Writes the buffers in Chrome trace event format (chrome://tracing, Perfetto).'''
+        trace_events = [{'name': name, 'cat': name.split('/')[0], 'ph': 'X', 'pid': 0, 'tid': 0,
+                         'ts': 1e6 * (start - self._origin), 'dur': 1e6 * duration}
+                        for start, duration, name in self._events()]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+
+    def dumpCSV(self, path: str):
+        with open(path, 'w') as file:
+            file.write('phase,start_s,duration_s\n')
+            for start, duration, name in self._events():
+                file.write(f'{name},{start - self._origin:.6f},{duration:.6f}\n')
+
+
+# Shared by the window loop and the simulation
+profiler = Profiler()
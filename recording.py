@@ -0,0 +1,176 @@
+'''Compact recordings of simulation runs.
+
+A recording file is
+    MAGIC, uint32 header length, JSON header, int32 bonds (bond_count × 2),
+    frames...,
+    int64 frame offsets, uint8 frame kinds (frame_count each),
+    uint64 index offset, uint64 frame count, END_MAGIC
+The header holds the static polygons, the encoding and its quantization. Bonds are
+indices into the recorded particles. Every frame holds the positions of all recorded
+particles as
+    KEYFRAME_FLOAT    float32 N×2
+    KEYFRAME_INT16    int16 N×2 quantized positions
+    DELTA_INT8        int8 N×2 change in quantized position since the frame before
+'''
+import json
+import numpy as np
+from bounds import PolygonalBound
+from static_body import StaticBody
+
+MAGIC = b'SBREC\x00\x00\x01'
+END_MAGIC = b'SBRECEND'
+
+KEYFRAME_FLOAT = 0
+KEYFRAME_INT16 = 1
+DELTA_INT8 = 2
+
+ENCODINGS = ('float32', 'quantized', 'delta')
+
+class Recorder:
+    '''Streams the positions of a state's particles into a recording file, one frame
+    per capture.
+
+        float32     exact to float32
+        quantized   int16 positions on a grid of `precision` pixels
+        delta       int8 changes in quantized position, with an int16 keyframe at
+                    least every KEYFRAME_INTERVAL frames and whenever a particle
+                    moves too far for int8
+    '''
+
+    KEYFRAME_INTERVAL = 30
+    QUANTIZED_RANGE = 2**15 - 1
+
+    def __init__(self, path: str, state, canvas_size, encoding='delta', dt=None, snapshot=None):
+        '''Records the state's particles and the bonds between them. While another thread
+        steps the state (see SimulationThread), pass its latest snapshot to take them
+        from instead, as the thread rewrites the live arrays.'''
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown recording encoding {encoding!r}, expected one of {ENCODINGS}')
+        self.encoding = encoding
+        source = state if snapshot is None else snapshot
+        self.particle_indices = np.array(source.particle_indices)
+        # Quantize onto a grid that covers twice the canvas around its center
+        self.center = np.array(canvas_size, dtype=float) / 2
+        self.precision = max(canvas_size) / Recorder.QUANTIZED_RANGE
+
+        # Bonds between recorded particles, as indices into the recorded particles
+        if snapshot is None:
+            i1, i2 = state.springs.i1[:state.springs.count], state.springs.i2[:state.springs.count]
+        else:
+            i1, i2 = snapshot.bond_ends
+        recorded = np.full(1 + max(i1.max(initial=-1), i2.max(initial=-1), self.particle_indices.max(initial=-1)),
+                           -1, dtype=np.int64)
+        recorded[self.particle_indices] = np.arange(len(self.particle_indices))
+        bonds = np.stack([recorded[i1], recorded[i2]], axis=1)
+        bonds = bonds[(bonds >= 0).all(axis=1)].astype(np.int32)
+
+        header = {
+            'particles': len(self.particle_indices),
+            'bond_count': len(bonds),
+            'canvas_size': list(canvas_size),
+            'encoding': encoding,
+            'center': self.center.tolist(),
+            'precision': self.precision,
+            'dt': dt,
+            'staticbodies': [{'points': _ringToList(staticbody.shape.points),
+                              'holes': [_ringToList(hole) for hole in staticbody.shape.holes]}
+                             for staticbody in state.staticbodies],
+        }
+        header_bytes = json.dumps(header).encode()
+
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(np.uint32(len(header_bytes)).tobytes())
+        self.file.write(header_bytes)
+        self.file.write(bonds.tobytes())
+        self.offsets = []
+        self.kinds = []
+        self._last_quantized = None
+
+    def capture(self, positions: np.ndarray):
+        '''Writes a frame from store-wide positions (e.g. ParticleArray.pos or a
+        snapshot), of which only the recorded particles are kept.'''
+        positions = positions[self.particle_indices]
+        self.offsets.append(self.file.tell())
+        if self.encoding == 'float32':
+            self.kinds.append(KEYFRAME_FLOAT)
+            self.file.write(positions.astype(np.float32).tobytes())
+            return
+
+        quantized = np.clip(np.round((positions - self.center) / self.precision),
+                            -Recorder.QUANTIZED_RANGE, Recorder.QUANTIZED_RANGE).astype(np.int16)
+        if self.encoding == 'delta' and self._last_quantized is not None and len(self.kinds) % Recorder.KEYFRAME_INTERVAL:
+            delta = quantized.astype(np.int32) - self._last_quantized
+            if np.abs(delta).max(initial=0) <= 127:
+                self.kinds.append(DELTA_INT8)
+                self.file.write(delta.astype(np.int8).tobytes())
+                self._last_quantized = quantized.astype(np.int32)
+                return
+        self.kinds.append(KEYFRAME_INT16)
+        self.file.write(quantized.tobytes())
+        self._last_quantized = quantized.astype(np.int32)
+
+    def close(self):
+        '''Writes the frame index. The file is not a valid recording until closed.'''
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.offsets, dtype=np.int64).tobytes())
+        self.file.write(np.array(self.kinds, dtype=np.uint8).tobytes())
+        self.file.write(np.array([index_offset, len(self.offsets)], dtype=np.uint64).tobytes())
+        self.file.write(END_MAGIC)
+        self.file.close()
+
+
+def _ringToList(ring) -> list:
+    return [[float(x), float(y)] for x, y in ring]
+
+
+class Recording:
+    '''A recording file opened for replay. The file is memory-mapped and frames are
+    decoded on demand; a frame is never more than KEYFRAME_INTERVAL deltas away from a
+    keyframe, so any frame can be reached quickly.'''
+
+    def __init__(self, path: str):
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.data[:len(MAGIC)]) != MAGIC or bytes(self.data[-len(END_MAGIC):]) != END_MAGIC:
+            raise ValueError(f'{path} is not a complete recording')
+        header_length = int(self.data[len(MAGIC):len(MAGIC) + 4].view(np.uint32)[0])
+        header_start = len(MAGIC) + 4
+        self.header = json.loads(bytes(self.data[header_start:header_start + header_length]))
+        self.particle_count = self.header['particles']
+        self.center = np.array(self.header['center'])
+        self.precision = self.header['precision']
+
+        bonds_start = header_start + header_length
+        bond_bytes = self.header['bond_count'] * 2 * 4
+        self.bonds = self.data[bonds_start:bonds_start + bond_bytes].view(np.int32).reshape(-1, 2)
+
+        trailer = self.data[-len(END_MAGIC) - 16:-len(END_MAGIC)].view(np.uint64)
+        index_offset, frame_count = int(trailer[0]), int(trailer[1])
+        self.offsets = self.data[index_offset:index_offset + 8*frame_count].view(np.int64)
+        self.kinds = self.data[index_offset + 8*frame_count:index_offset + 9*frame_count]
+        # Latest keyframe at or before every frame
+        frame_numbers = np.arange(frame_count)
+        self.keyframes = np.maximum.accumulate(np.where(self.kinds != DELTA_INT8, frame_numbers, 0))
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def _raw(self, frame: int, dtype) -> np.ndarray:
+        start = int(self.offsets[frame])
+        size = self.particle_count * 2 * np.dtype(dtype).itemsize
+        return self.data[start:start + size].view(dtype).reshape(-1, 2)
+
+    def frame(self, frame: int) -> np.ndarray:
+        '''Positions of the recorded particles in the given frame.'''
+        if self.kinds[frame] == KEYFRAME_FLOAT:
+            return self._raw(frame, np.float32).astype(float)
+        keyframe = int(self.keyframes[frame])
+        quantized = self._raw(keyframe, np.int16).astype(np.int32)
+        for delta_frame in range(keyframe + 1, frame + 1):
+            quantized += self._raw(delta_frame, np.int8)
+        return quantized * self.precision + self.center
+
+    def staticbodies(self) -> list[StaticBody]:
+        return [StaticBody(PolygonalBound([tuple(point) for point in staticbody['points']],
+                                          [[tuple(point) for point in hole] for hole in staticbody['holes']]))
+                for staticbody in self.header['staticbodies']]
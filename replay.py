@@ -0,0 +1,97 @@
+'''Replays a recording without running any physics.
+
+    python replay.py recording.sbr                      Scrub through it in a window
+    python replay.py recording.sbr --export frames/     Save every frame as a PNG
+
+In the window, Space plays and pauses, Left/Right step a frame (10 with Shift), Home
+and End jump to the ends and clicking the bar at the bottom jumps to that point.
+'''
+import os
+from argparse import ArgumentParser
+import pygame
+from pygame import Surface
+from dynamic_window import DynamicWindow
+from main import SimulationState
+from recording import Recording
+
+BG_COLOR = (10, 10, 15)
+
+def exportImages(recording: Recording, directory: str, every=1, bg_color=BG_COLOR):
+    '''Renders every `every`th frame of a recording to directory/frame_00000.png etc.'''
+    os.makedirs(directory, exist_ok=True)
+    state = SimulationState.fromRecording(recording)
+    screen = Surface(recording.header['canvas_size'])
+    for frame in range(0, len(recording), every):
+        screen.fill(bg_color)
+        state.renderPositions(screen, recording.frame(frame), state.particle_indices)
+        pygame.image.save(screen, os.path.join(directory, f'frame_{frame:05d}.png'))
+
+
+class ReplayWindow(DynamicWindow):
+
+    SCRUB_BAR_HEIGHT = 6
+    SCRUB_BAR_COLOR = (60, 60, 80)
+    SCRUB_HEAD_COLOR = (200, 200, 220)
+
+    def __init__(self, recording: Recording, bg_color=BG_COLOR):
+        super().__init__(tuple(recording.header['canvas_size']), bg_color)
+        self.recording = recording
+        self.state = SimulationState.fromRecording(recording)
+        self.frame_number = 0
+        self.playing = False
+        # Frames advance at the recorded step rate when it is known
+        self.frame_dt = recording.header['dt'] or 1/60
+        self.play_time = 0
+
+    def seek(self, frame_number):
+        self.frame_number = max(0, min(len(self.recording) - 1, frame_number))
+
+    def update(self, dt, events):
+        for event in events:
+            if event.type == pygame.KEYDOWN:
+                step = 10 if event.mod & pygame.KMOD_SHIFT else 1
+                match event.key:
+                    case pygame.K_SPACE:
+                        self.playing = not self.playing
+                    case pygame.K_RIGHT:
+                        self.seek(self.frame_number + step)
+                    case pygame.K_LEFT:
+                        self.seek(self.frame_number - step)
+                    case pygame.K_HOME:
+                        self.seek(0)
+                    case pygame.K_END:
+                        self.seek(len(self.recording) - 1)
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == pygame.BUTTON_LEFT:
+                if event.pos[1] >= self.resolution[1] - 3*ReplayWindow.SCRUB_BAR_HEIGHT:
+                    self.seek(round(event.pos[0] / self.resolution[0] * (len(self.recording) - 1)))
+
+        if self.playing:
+            self.play_time += dt
+            frames = int(self.play_time / self.frame_dt)
+            self.play_time -= frames * self.frame_dt
+            self.seek(self.frame_number + frames)
+
+    def render(self, screen, res):
+        if len(self.recording) == 0:
+            return
+        self.state.renderPositions(screen, self.recording.frame(self.frame_number), self.state.particle_indices)
+        # Scrub bar
+        width, height = res
+        bar_top = height - ReplayWindow.SCRUB_BAR_HEIGHT
+        pygame.draw.rect(screen, ReplayWindow.SCRUB_BAR_COLOR, (0, bar_top, width, ReplayWindow.SCRUB_BAR_HEIGHT))
+        head_x = self.frame_number / max(1, len(self.recording) - 1) * width
+        pygame.draw.rect(screen, ReplayWindow.SCRUB_HEAD_COLOR, (head_x - 2, bar_top, 4, ReplayWindow.SCRUB_BAR_HEIGHT))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Replay a softbody recording.')
+    parser.add_argument('recording')
+    parser.add_argument('--export', metavar='DIRECTORY', help='save the frames as PNGs instead of opening a window')
+    parser.add_argument('--every', type=int, default=1, help='only export every nth frame')
+    args = parser.parse_args()
+
+    recording = Recording(args.recording)
+    if args.export:
+        exportImages(recording, args.export, args.every)
+    else:
+        ReplayWindow(recording).start()
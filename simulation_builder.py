@@ -1,126 +1,210 @@
-from pygame import Vector2, surfarray, Surface, draw
+from pygame import surfarray, Surface
+import numpy as np
 from static_body import StaticBody
 from particle import Particle
 from spring_bond import SpringBond
+from world import World
 from bounds import PolygonalBound
+from contours import traceContours
 
-def buildStaticbodies(canvas: Surface, body_color, voxel_size) -> list[StaticBody]:
+def buildStaticShapes(canvas: Surface, body_color, tolerance) -> list[tuple[list, list[list]]]:
+    '''Traces the staticbody regions of the canvas and simplifies their outlines to
+    within tolerance pixels. Returns the (outer points, hole point lists) of every region.'''
+    return simplifyShapes(traceContours(bodyMask(canvas, body_color)), tolerance)
+
+def bodyMask(canvas: Surface, body_color) -> np.ndarray:
+    '''Pixels of the canvas in the body color, indexed [x][y].'''
     body_color = canvas.map_rgb((body_color[0], body_color[1], body_color[2], 255))
-    canvas_array = surfarray.pixels2d(canvas)
-    # Canvas dimensions
-    canvas_width = len(canvas_array[0])
-    canvas_height = len(canvas_array)
-    '''Find staticbody pixels adjacent to either the edge of the canvas or
-    to a non-staticbody pixel.'''
-    edge_points = []
-    for y in range(canvas_height):
-        for x in range(canvas_width):
-            # Ignore this pixel if not staticbody
-            if canvas_array[y][x] != body_color:
-                continue
-            # Plot adjacent pixels including this one (True for staticbody, False for not)
-            flattened_adjacent_map = []
-            for ix in range(-1, 2):
-                for iy in range(-1, 2):
-                    if ((x+ix < 0) or (x+ix >= canvas_width) or
-                        (y+iy < 0) or (y+iy >= canvas_height)):
-                        flattened_adjacent_map.append(False)
-                    else:
-                        flattened_adjacent_map.append(canvas_array[y+iy][x+ix] == body_color)
-            # Add this pixel if one or more of the adjacent pixels are not a staticbody
-            if (not flattened_adjacent_map[4]) in flattened_adjacent_map:
-                edge_points.append((y, x))
-    
-    '''Get shapes from edge points'''
-    points_queue = edge_points
-    shapes = []
-    while len(points_queue) > 0:
-        shape = [points_queue[0]]
-        points_queue.remove(points_queue[0])
-
-        is_chain_complete = len(points_queue) == 0
-        while not is_chain_complete:
-            current_point = shape[-1]
-
-            # Points and their squared distances [((x, y), squared_distance)]
-            point_distances = []
-            for point in points_queue:
-                squared_dist = (current_point[0] - point[0])**2 + (current_point[1] - point[1])**2
-                point_distances.append((point, squared_dist))
-
-            # Find the point with the smallest distance
-            closest_point_data = min(point_distances, key=lambda data: data[1])
-            closest_point = closest_point_data[0]
-            closest_point_s_dist = closest_point_data[1]
-
-            # Complete the chain if the closest point is not an adjacent voxel
-            is_chain_complete = closest_point_s_dist > 2
-            
-            # Otherwise add the closest point to the shape
-            if not is_chain_complete:
-                shape.append(closest_point)
-                points_queue.remove(closest_point)
-                if len(points_queue) == 0:
-                    is_chain_complete = True
-        
-        shapes.append(shape)
-
-    # Reduce the number of point in each shape
-    shapes = [[shape[i] for i in range(0, len(shape), voxel_size)] for shape in shapes]
-
-    # Make sure there are no shapes with <3 verts
-    shapes = [shape for shape in shapes if len(shape) >= 3]
-
-    return [StaticBody(PolygonalBound(shape)) for shape in shapes]
-
-
-def buildSoftbodies(canvas: Surface, body_color, voxel_size, particle_mass, spring_k) -> tuple[list[Particle], list[SpringBond]]:
+    return surfarray.pixels2d(canvas) == body_color
+
+def simplifyShapes(shapes: list, tolerance) -> list[tuple[list, list[list]]]:
+    '''Reduces traced (outer, holes) outlines to the points that become staticbody
+    vertices, never moving the outline by more than tolerance pixels (see simplifyLoop).'''
+    shapes = [(simplifyLoop(outer, tolerance), [simplifyLoop(hole, tolerance) for hole in holes])
+              for outer, holes in shapes]
+
+    # Make sure there are no loops with <3 verts
+    return [(outer, [hole for hole in holes if len(hole) >= 3]) for outer, holes in shapes if len(outer) >= 3]
+
+def simplifyLoop(loop: list, tolerance) -> list:
+    '''Douglas-Peucker simplification of a closed loop of points: the loop is split at
+    its first point and the point farthest from it, and each half keeps the point
+    farthest from the segment between its ends for as long as that is more than
+    tolerance away, then is split there in turn.'''
+    if len(loop) < 3:
+        return loop
+    points = np.array(loop, dtype=float)
+    # Closed, so that the second half ends back at the first point
+    chain = np.concatenate([points, points[:1]])
+    count = len(points)
+    farthest = int(np.argmax(np.einsum('ij,ij->i', points - points[0], points - points[0])))
+    if farthest == 0:
+        return loop[:1]
+    keep = np.zeros(count + 1, dtype=bool)
+    keep[[0, farthest, count]] = True
+
+    spans = [(0, farthest), (farthest, count)]
+    while len(spans) > 0:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+        # Distances from the points between the ends to the segment joining the ends
+        a, b = chain[start], chain[end]
+        segment = b - a
+        offsets = chain[start + 1:end] - a
+        length_squared = segment @ segment
+        along = np.clip(offsets @ segment / length_squared, 0, 1) if length_squared != 0 else np.zeros(len(offsets))
+        deviations = offsets - along[:, None] * segment
+        distances_squared = np.einsum('ij,ij->i', deviations, deviations)
+        worst = int(np.argmax(distances_squared))
+        if distances_squared[worst] > tolerance**2:
+            middle = start + 1 + worst
+            keep[middle] = True
+            spans += [(start, middle), (middle, end)]
+
+    return [loop[i] for i in np.flatnonzero(keep[:count])]
+
+def vertexCount(shapes: list) -> int:
+    '''Total number of points in a list of (outer, holes) outlines.'''
+    return sum(len(outer) + sum(len(hole) for hole in holes) for outer, holes in shapes)
+
+def buildStaticbodies(canvas: Surface, body_color, tolerance, world: World) -> list[StaticBody]:
+    staticbodies = [StaticBody(PolygonalBound(outer, holes)) for outer, holes in buildStaticShapes(canvas, body_color, tolerance)]
+    world.addStaticbodies(staticbodies)
+    return staticbodies
+
+
+# Voxel offsets that each voxel is bonded along (the other four directions are their mirrors)
+BOND_DIRECTIONS = [(1, 0), (0, 1), (1, 1), (1, -1)]
+
+def buildSoftbodyArrays(canvas: Surface, body_color, voxel_size) -> tuple[np.ndarray, np.ndarray]:
+    '''Samples the softbody voxels of the canvas. Returns an N×2 array of particle
+    positions (voxel centres) and an M×2 array of particle index pairs to bond, ready
+    to be added to a ParticleArray and SpringArray.'''
+    return softbodyArraysFromOccupancy(softbodyOccupancy(canvas, body_color, voxel_size), voxel_size)
+
+def softbodyOccupancy(canvas: Surface, body_color, voxel_size) -> np.ndarray:
+    '''Occupancy of every voxel whose centre pixel is on the canvas, indexed [x][y].'''
     body_color = canvas.map_rgb((body_color[0], body_color[1], body_color[2], 255))
-    canvas_array = surfarray.pixels2d(canvas)
-    # Canvas dimensions
-    canvas_width = len(canvas_array)
-    canvas_height = len(canvas_array[0])
-
-    '''Create a map of particles vs empty space (None). Wider than the canvas'''
-    voxel_resolution = (int(canvas_width / voxel_size), int(canvas_height / voxel_size))
-    particle_map = []
-    created_particles = [] # Keep track of created particles
-    for vx in range(-1, voxel_resolution[0] + 1):
-        column = []
-        for vy in range(-1, voxel_resolution[1] + 1):
-            # Center coords of the voxel
-            x_center = vx * voxel_size + int(voxel_size/2)
-            y_center = vy * voxel_size + int(voxel_size/2)
-            if ((x_center < 0) or (x_center >= canvas_width) or
-                (y_center < 0) or (y_center >= canvas_height)):
-                # Center pixel is not on the canvas
-                column.append(None)
-            else:
-                if canvas_array[x_center][y_center] == body_color:
-                    particle = Particle(Vector2(x_center, y_center),
-                                                      Vector2(0,0), 
-                                                      particle_mass)
-                    column.append(particle)
-                    created_particles.append(particle)
-                else:
-                    column.append(None)
-        particle_map.append(column)
-    
-    '''Create bonds between particles in adjacent voxels.'''
-    created_bonds = []
-    for vx in range(voxel_resolution[0]):
-        for vy in range(voxel_resolution[1]):
-            if not particle_map[vx][vy]:
-                continue
-            current_particle = particle_map[vx][vy]
-
-            if particle_map[vx + 1][vy]:
-                created_bonds.append(SpringBond(current_particle, particle_map[vx + 1][vy], spring_k))
-            if particle_map[vx][vy + 1]:
-                created_bonds.append(SpringBond(current_particle, particle_map[vx][vy + 1], spring_k))
-            if particle_map[vx + 1][vy + 1]:
-                created_bonds.append(SpringBond(current_particle, particle_map[vx + 1][vy + 1], spring_k))
-            if particle_map[vx + 1][vy - 1]:
-                created_bonds.append(SpringBond(current_particle, particle_map[vx + 1][vy - 1], spring_k))
-
-    return(created_particles, created_bonds)
\ No newline at end of file
+    half_voxel = int(voxel_size/2)
+    return surfarray.pixels2d(canvas)[half_voxel::voxel_size, half_voxel::voxel_size] == body_color
+
+def softbodyArraysFromOccupancy(occupied: np.ndarray, voxel_size) -> tuple[np.ndarray, np.ndarray]:
+    '''Particle positions and bonds (see buildSoftbodyArrays) of a voxel occupancy grid.'''
+    positions, bonds, _ = meshOccupancy(occupied, voxel_size)
+    return (positions, bonds)
+
+def meshOccupancy(occupied: np.ndarray, voxel_size, max_cell_size=1) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Meshes a voxel occupancy grid like softbodyArraysFromOccupancy, but merges the
+    interior into square cells of up to max_cell_size voxels a side (rounded down to a
+    power of two) with one particle each. A quadtree cell is merged when it and the
+    ring of voxels around it are all occupied, largest cells first, so the outline
+    keeps its single voxels. Cells are bonded where any of their voxels are, so
+    resolutions join up without gaps. Returns the particle positions (cell centres),
+    bonds and the side of every particle's cell in voxels, to scale its mass by.'''
+    width, height = occupied.shape
+    # Side of the cell starting at each voxel, 0 where no cell starts
+    cell_sides = np.zeros(occupied.shape, dtype=np.int64)
+    merged = np.zeros(occupied.shape, dtype=bool)
+    # Occupied voxels in any box, from a summed area table of the grid with an empty ring around it
+    table = np.zeros((width + 3, height + 3), dtype=np.int64)
+    table[1:, 1:] = np.pad(occupied, 1).cumsum(axis=0).cumsum(axis=1)
+    side = 1 << (max(1, int(max_cell_size)).bit_length() - 1)
+    while side > 1:
+        columns, rows = width // side, height // side
+        xs, ys = np.meshgrid(np.arange(columns) * side, np.arange(rows) * side, indexing='ij')
+        # The cell and its ring span [x - 1, x + side + 1) of the grid, [x, x + side + 2) of the table
+        span = side + 2
+        counts = table[xs + span, ys + span] - table[xs, ys + span] - table[xs + span, ys] + table[xs, ys]
+        # Cells are aligned, so one inside a merged larger cell has its first voxel merged
+        cells = (counts == span**2) & ~merged[xs, ys]
+        cell_sides[xs[cells], ys[cells]] = side
+        merged[:columns*side, :rows*side] |= np.repeat(np.repeat(cells, side, axis=0), side, axis=1)
+        side //= 2
+    cell_sides[occupied & ~merged] = 1
+
+    half_voxel = int(voxel_size/2)
+    cells = np.argwhere(cell_sides)
+    sides = cell_sides[cells[:, 0], cells[:, 1]]
+    positions = cells * voxel_size + half_voxel + (sides[:, None] - 1) * voxel_size / 2
+    particle_ids = np.full(occupied.shape, -1, dtype=np.int64)
+    for dx in range(sides.max(initial=1)):
+        for dy in range(sides.max(initial=1)):
+            covering = sides > max(dx, dy)
+            particle_ids[cells[covering, 0] + dx, cells[covering, 1] + dy] = np.flatnonzero(covering)
+
+    '''Bond particles in adjacent voxels: intersect the occupancy with a shifted copy of itself.'''
+    bond_sources, bond_targets, bond_directions = [], [], []
+    for direction, (dx, dy) in enumerate(BOND_DIRECTIONS):
+        sources = (slice(0, width - dx), slice(max(0, -dy), height - max(0, dy)))
+        targets = (slice(dx, width), slice(max(0, dy), height - max(0, -dy)))
+        both = occupied[sources] & occupied[targets]
+        bond_sources.append(particle_ids[sources][both])
+        bond_targets.append(particle_ids[targets][both])
+        bond_directions.append(np.full(np.count_nonzero(both), direction))
+    bond_sources = np.concatenate(bond_sources)
+    bond_targets = np.concatenate(bond_targets)
+    bond_directions = np.concatenate(bond_directions)
+    # Voxels of one cell are not bonded, and neighbouring cells only once, from the lower particle
+    between = bond_sources != bond_targets
+    bond_sources, bond_targets = bond_sources[between], bond_targets[between]
+    bond_sources, bond_targets = np.minimum(bond_sources, bond_targets), np.maximum(bond_sources, bond_targets)
+    # Order bonds by source particle, then by direction
+    order = np.lexsort((bond_directions[between], bond_sources))
+    _, first = np.unique(bond_sources[order] * len(cells) + bond_targets[order], return_index=True)
+    order = order[np.sort(first)]
+    bonds = np.stack((bond_sources[order], bond_targets[order]), axis=1)
+
+    return (positions, bonds, sides)
+
+
+def buildSoftbodies(canvas: Surface, body_color, voxel_size, particle_mass, spring_k,
+                    world: World, max_cell_size=1) -> tuple[list[Particle], list[SpringBond]]:
+    '''Builds the softbodies of the canvas into the given world and returns views onto
+    the created particles and bonds. With max_cell_size, the interiors are meshed
+    coarser (see meshOccupancy) and particle_mass is the mass of a single voxel.'''
+    positions, bonds, sides = meshOccupancy(softbodyOccupancy(canvas, body_color, voxel_size), voxel_size, max_cell_size)
+    return addSoftbodies(world, positions, bonds, particle_mass * sides**2, spring_k)
+
+def addSoftbodies(world: World, positions: np.ndarray, bonds: np.ndarray, particle_mass,
+                  spring_k) -> tuple[list[Particle], list[SpringBond]]:
+    '''Adds particles at the given positions and the bonds between them (as returned
+    by buildSoftbodyArrays) like buildSoftbodies. particle_mass is one mass for every
+    particle or an array of them.'''
+    particle_indices = world.spawn(positions, np.zeros_like(positions), particle_mass)
+    created_particles = Particle.fromIndices(world.particles, particle_indices)
+
+    bond_indices = world.springs.addMany(world.particles, particle_indices[bonds[:, 0]],
+                                         particle_indices[bonds[:, 1]], spring_k)
+    created_bonds = SpringBond.fromIndices(world.springs, bond_indices,
+                                           [(created_particles[i1], created_particles[i2]) for i1, i2 in bonds.tolist()])
+
+    return (created_particles, created_bonds)
+
+
+class Scene:
+    '''Everything built from a canvas, as plain arrays and point lists: the softbody
+    particle positions and bonds (see buildSoftbodyArrays) and the static shapes (see
+    buildStaticShapes), along with the mass and stiffness to build them with. Particles
+    of coarse cells (see meshOccupancy) weigh particle_mass per voxel of their cell.'''
+
+    def __init__(self, positions: np.ndarray, bonds: np.ndarray, static_shapes: list, particle_mass, spring_k,
+                 cell_sides: np.ndarray = None):
+        self.positions = positions
+        self.bonds = bonds
+        self.static_shapes = static_shapes
+        self.particle_mass = particle_mass
+        self.spring_k = spring_k
+        self.cell_sides = np.ones(len(positions), dtype=np.int64) if cell_sides is None else cell_sides
+        # DistanceField of the canvas, once built, kept with the scene so that cached scenes reuse it
+        self.distance_field = None
+
+    def particleMasses(self) -> np.ndarray:
+        return self.particle_mass * self.cell_sides**2.0
+
+def buildScene(canvas: Surface, softbody_color, staticbody_color, edge_tolerance, build_voxel_size,
+               particle_mass, spring_k, max_cell_size=1) -> Scene:
+    positions, bonds, sides = meshOccupancy(softbodyOccupancy(canvas, softbody_color, build_voxel_size),
+                                            build_voxel_size, max_cell_size)
+    return Scene(positions, bonds, buildStaticShapes(canvas, staticbody_color, edge_tolerance), particle_mass, spring_k,
+                 sides)
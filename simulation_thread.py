@@ -0,0 +1,147 @@
+from threading import Thread, Lock
+from queue import SimpleQueue, Empty
+from time import perf_counter, sleep
+import numpy as np
+from physics_clock import PhysicsClock
+
+class Snapshot:
+    '''Copy of the particle positions after a finished step, reusing its arrays
+    between copies, and of the bond ends whenever they change.'''
+
+    def __init__(self):
+        self.pos = np.zeros((0, 2))
+        self.count = 0
+        self.particle_indices = np.zeros(0, dtype=int)
+        self.bond_ends = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self.topology_version = -1
+        self.step = 0
+        self.sim_time = 0
+
+    def copyFrom(self, state, step, sim_time):
+        store = state.world.particles
+        if len(self.pos) < store.count:
+            self.pos = np.zeros((len(store.pos), 2))
+        self.count = store.count
+        self.pos[:store.count] = store.pos[:store.count]
+        # Replaced rather than modified when particles are spawned, so it can be shared
+        self.particle_indices = state.particle_indices
+        # Despawning rewrites the live bond arrays in place, so the render thread draws from a copy
+        springs = state.springs
+        if self.topology_version != springs.topology_version:
+            self.bond_ends = (springs.i1[:springs.count].copy(), springs.i2[:springs.count].copy())
+            self.topology_version = springs.topology_version
+        self.step = step
+        self.sim_time = sim_time
+
+    def positions(self) -> np.ndarray:
+        return self.pos[:self.count]
+
+
+class SnapshotBuffer:
+    '''Triple buffer of snapshots. The writer always has a slot of its own to fill, the
+    reader keeps the slot it last read until it reads again, and the third slot holds
+    the latest published snapshot. Neither side ever waits for the other beyond
+    swapping slot numbers.'''
+
+    def __init__(self):
+        self._slots = [Snapshot(), Snapshot(), Snapshot()]
+        self._lock = Lock()
+        self._writing = 0
+        self._latest = None
+        self._reading = None
+
+    def writeSlot(self) -> Snapshot:
+        return self._slots[self._writing]
+
+    def publish(self):
+        '''Makes the write slot the latest snapshot and moves on to a free slot.'''
+        with self._lock:
+            self._latest = self._writing
+            self._writing = next(slot for slot in range(3) if slot not in (self._latest, self._reading))
+
+    def read(self) -> Snapshot:
+        '''The latest published snapshot, or None before the first one.'''
+        with self._lock:
+            self._reading = self._latest
+        return None if self._reading is None else self._slots[self._reading]
+
+
+class SimulationThread(Thread):
+    '''Steps a SimulationState on its own thread and publishes every finished step to
+    a SnapshotBuffer. Other threads change the simulation only by sending commands,
+    which are applied between steps.
+
+    When realtime, fixed steps are taken to keep up with the wall clock (see
+    PhysicsClock); otherwise the thread steps as fast as it can.'''
+
+    SPAWN = 'spawn' # (positions, velocities, mass)
+    PAUSE = 'pause'
+    RESUME = 'resume'
+    STOP = 'stop'
+
+    IDLE_SLEEP = 1/1000 # Seconds to sleep when there is no step to take
+
+    def __init__(self, state, fixed_dt: float, max_substeps: int, realtime=True):
+        super().__init__(daemon=True)
+        self.state = state
+        self.clock = PhysicsClock(fixed_dt, max_substeps)
+        self.realtime = realtime
+        self.snapshots = SnapshotBuffer()
+        self.commands = SimpleQueue()
+        self.paused = False
+        self.running = True
+        self.step = 0
+
+    def send(self, command: str, *args):
+        self.commands.put((command, args))
+
+    def stop(self):
+        '''Stops the thread after its current step and waits for it.'''
+        self.send(SimulationThread.STOP)
+        self.join()
+
+    def _handleCommands(self):
+        while True:
+            try:
+                command, args = self.commands.get_nowait()
+            except Empty:
+                return
+            match command:
+                case SimulationThread.SPAWN:
+                    self.state.spawn(*args)
+                case SimulationThread.PAUSE:
+                    self.paused = True
+                case SimulationThread.RESUME:
+                    self.paused = False
+                    self.last_time = perf_counter()
+                case SimulationThread.STOP:
+                    self.running = False
+
+    def _publish(self):
+        self.snapshots.writeSlot().copyFrom(self.state, self.step, self.step * self.clock.fixed_dt)
+        self.snapshots.publish()
+
+    def run(self):
+        self._publish()
+        self.last_time = perf_counter()
+        while True:
+            self._handleCommands()
+            if not self.running:
+                return
+
+            steps = 0
+            if not self.paused:
+                if self.realtime:
+                    now = perf_counter()
+                    steps = self.clock.advance(now - self.last_time)
+                    self.last_time = now
+                else:
+                    steps = 1
+            if steps == 0:
+                sleep(SimulationThread.IDLE_SLEEP)
+                continue
+
+            for _ in range(steps):
+                self.state.update(self.clock.fixed_dt)
+                self.step += 1
+            self._publish()
@@ -0,0 +1,78 @@
+import numpy as np
+
+class SpatialHash:
+    '''Uniform grid broadphase. Points are bucketed into square cells by sorting
+    on their cell key, so a rebuild is a single argsort and neighbouring cells can
+    be looked up for every point at once with searchsorted.'''
+
+    NEIGHBOUR_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+    MAX_COORDINATE = 1e9 # Points farther out than this (or not finite) are left out, as their keys would overflow
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.positions = np.zeros((0, 2))
+        self._cells = np.zeros((0, 2), dtype=np.int64)
+        self._valid = np.zeros(0, dtype=bool)
+        self._order = np.zeros(0, dtype=np.int64)
+        self._sorted_keys = np.zeros(0, dtype=np.int64)
+        self._rows = 1
+
+    def _keys(self, cells):
+        return cells[:, 0] * self._rows + cells[:, 1]
+
+    def build(self, positions: np.ndarray):
+        '''Rebuilds the grid from an N×2 array of positions. Points that are not finite,
+        e.g. after a step blew up, are in no cell and have no neighbours.'''
+        self.positions = positions
+        valid = (np.abs(positions) < SpatialHash.MAX_COORDINATE).all(axis=1)
+        cells = np.zeros((len(positions), 2), dtype=np.int64)
+        cells[valid] = np.floor(positions[valid] / self.cell_size)
+        if valid.any():
+            # Shift cells so that every neighbour of an occupied cell has a non-negative key
+            cells[valid] -= cells[valid].min(axis=0) - 1
+            self._rows = int(cells[valid, 1].max()) + 2
+        self._cells = cells
+        self._valid = valid
+        # Left out points get a key that no lookup asks for
+        keys = np.where(valid, self._keys(cells), -1)
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._order]
+
+    def candidatePairs(self, indices=None) -> tuple[np.ndarray, np.ndarray]:
+        '''Gets every (i, j) pair, i != j, where j lies in one of the 3×3 cells around i.
+        Pairs are returned in both directions, only for i in the given indices
+        (all points by default).'''
+        if indices is None:
+            indices = np.arange(len(self._cells))
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = indices[self._valid[indices]]
+        cells = self._cells[indices]
+
+        pair_i, pair_j = [], []
+        for dx, dy in SpatialHash.NEIGHBOUR_OFFSETS:
+            keys = self._keys(cells + (dx, dy))
+            starts = np.searchsorted(self._sorted_keys, keys, side='left')
+            ends = np.searchsorted(self._sorted_keys, keys, side='right')
+            counts = ends - starts
+            total = counts.sum()
+            if total == 0:
+                continue
+            # Expand each [start, end) range into the sorted positions it covers
+            run_offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            pair_i.append(np.repeat(indices, counts))
+            pair_j.append(self._order[np.repeat(starts, counts) + run_offsets])
+
+        if len(pair_i) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        pair_i = np.concatenate(pair_i)
+        pair_j = np.concatenate(pair_j)
+        not_self = pair_i != pair_j
+        return (pair_i[not_self], pair_j[not_self])
+
+    def contactPairs(self, radius: float, indices=None) -> tuple[np.ndarray, np.ndarray]:
+        '''Gets the candidate pairs that are within radius of each other and not coincident.'''
+        pair_i, pair_j = self.candidatePairs(indices)
+        offsets = self.positions[pair_j] - self.positions[pair_i]
+        squared_dists = np.einsum('ij,ij->i', offsets, offsets)
+        in_contact = (squared_dists <= radius**2) & (squared_dists != 0)
+        return (pair_i[in_contact], pair_j[in_contact])
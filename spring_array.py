@@ -0,0 +1,93 @@
+import numpy as np
+from particle_array import ParticleArray
+
+class SpringArray:
+    '''Batched store of spring bonds. Each bond is a pair of particle indices into a
+    ParticleArray plus its rest length and stiffness, and every bond's spring and
+    damping force is computed in one pass.'''
+
+    DAMPING = 10
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.count = 0
+        # Changes whenever bonds are added, removed or renumbered, for telling when copies of i1/i2 are out of date
+        self.topology_version = 0
+        self._allocate(max(1, capacity))
+
+    def _allocate(self, capacity):
+        self.i1 = np.zeros(capacity, dtype=np.int64)
+        self.i2 = np.zeros(capacity, dtype=np.int64)
+        self.rest_length = np.zeros(capacity)
+        self.k = np.zeros(capacity)
+
+    def _grow(self, min_capacity):
+        capacity = len(self.k)
+        if min_capacity <= capacity:
+            return
+        while capacity < min_capacity:
+            capacity *= 2
+        old = (self.i1, self.i2, self.rest_length, self.k)
+        self._allocate(capacity)
+        for new_array, old_array in zip((self.i1, self.i2, self.rest_length, self.k), old):
+            new_array[:self.count] = old_array[:self.count]
+
+    def add(self, particles: ParticleArray, i1: int, i2: int, k: float) -> int:
+        '''Adds a single bond at its current length and returns its index.'''
+        return int(self.addMany(particles, [i1], [i2], k)[0])
+
+    def addMany(self, particles: ParticleArray, i1, i2, k) -> np.ndarray:
+        '''Adds a batch of bonds between particle indices, each resting at the current
+        distance between its particles, and returns their indices.'''
+        i1 = np.asarray(i1, dtype=np.int64)
+        i2 = np.asarray(i2, dtype=np.int64)
+        n = len(i1)
+        self._grow(self.count + n)
+        indices = np.arange(self.count, self.count + n)
+        self.i1[indices] = i1
+        self.i2[indices] = i2
+        self.rest_length[indices] = np.linalg.norm(particles.pos[i2] - particles.pos[i1], axis=1)
+        self.k[indices] = k
+        self.count += n
+        self.topology_version += 1
+        return indices
+
+    def keep(self, indices):
+        '''Packs the given bonds, in order, to the front of the store and drops the rest.'''
+        indices = np.asarray(indices, dtype=int)
+        for array in (self.i1, self.i2, self.rest_length, self.k):
+            array[:len(indices)] = array[indices]
+        self.count = len(indices)
+        self.topology_version += 1
+
+    def renumber(self, remap: np.ndarray):
+        '''Moves the ends of every bond to new particle indices, remap[old index].'''
+        self.i1[:self.count] = remap[self.i1[:self.count]]
+        self.i2[:self.count] = remap[self.i2[:self.count]]
+        self.topology_version += 1
+
+    def solve(self, particles: ParticleArray, indices=None):
+        '''Accumulates the spring and damping forces of the given bonds (all by default)
+        onto their particles. Bonds with zero length are skipped.'''
+        if indices is None:
+            indices = slice(0, self.count)
+        i1, i2 = self.i1[indices], self.i2[indices]
+        if len(i1) == 0:
+            return
+
+        spring_vecs = particles.pos[i2] - particles.pos[i1]
+        lengths = np.sqrt(np.einsum('ij,ij->i', spring_vecs, spring_vecs))
+        stretched = lengths != 0
+        directions = np.zeros_like(spring_vecs)
+        directions[stretched] = spring_vecs[stretched] / lengths[stretched, None]
+
+        resistance = self.k[indices] * (lengths - self.rest_length[indices])
+        damping = np.einsum('ij,ij->i', directions, particles.vel[i2] - particles.vel[i1]) * SpringArray.DAMPING
+        magnitudes = np.where(stretched, resistance + damping, 0)
+
+        # Scatter equal and opposite forces back onto both ends of every bond
+        forces = magnitudes[:, None] * directions
+        size = particles.count
+        for axis in range(2):
+            particles.force[:size, axis] += (np.bincount(i1, forces[:, axis], size)
+                                             - np.bincount(i2, forces[:, axis], size))
@@ -1,44 +1,74 @@
 from dynamic_object import Updatable, Renderable
 from particle import Particle
-from pygame import Vector2, draw
+from spring_array import SpringArray
+from pygame import draw
+from batch_render import drawSegments
 
 class SpringBond(Updatable, Renderable):
+    '''Thin view onto a single bond of a SpringArray.'''
 
     RENDER = True
     RENDER_COLOR = (200, 200, 220)
     RENDER_THICKNESS = 2
 
-    def __init__(self, particle1: Particle, particle2: Particle, k: float):
+    def __init__(self, particle1: Particle, particle2: Particle, k: float, store: SpringArray):
         self.p1 = particle1
         self.p2 = particle2
-        self.k = k
-        self.initial_length = self._getLength()
+        self.store = store
+        self.index = self.store.add(particle1.store, particle1.index, particle2.index, k)
+
+    @staticmethod
+    def fromIndices(store: SpringArray, indices, particle_pairs) -> list:
+        '''Creates views onto bonds that were added to the store in bulk, given the
+        (particle1, particle2) views of each bond.'''
+        bonds = []
+        for index, (particle1, particle2) in zip(indices, particle_pairs):
+            bond = SpringBond.__new__(SpringBond)
+            bond.p1 = particle1
+            bond.p2 = particle2
+            bond.store = store
+            bond.index = int(index)
+            bonds.append(bond)
+        return bonds
+
+    @property
+    def k(self) -> float:
+        return self.store.k[self.index]
+
+    @k.setter
+    def k(self, value):
+        self.store.k[self.index] = value
+
+    @property
+    def initial_length(self) -> float:
+        return self.store.rest_length[self.index]
 
     def _getLength(self):
         return (self.p2.pos - self.p1.pos).magnitude()
-    
+
     def _getSpringVector(self):
         '''Get the normalized vector pointing from particle 1 to 2.'''
         return (self.p2.pos - self.p1.pos).normalize()
 
     def update(self, dt):
-        length = self._getLength()
-        # Ignore this frame if the distance between the particles is zero
-        if length == 0: return
-        
-        length_delta = length - self.initial_length
-        resistance = self.k * length_delta
+        self.store.solve(self.p1.store, [self.index])
 
-        damping = (self.p2.pos - self.p1.pos).normalize() * (self.p2.vel - self.p1.vel) * 10
+    @staticmethod
+    def renderMany(screen, positions, springs: SpringArray):
+        '''Draws every bond of a SpringArray in one pass, given the positions of the
+        particles it connects.'''
+        SpringBond.renderEnds(screen, positions, springs.i1[:springs.count], springs.i2[:springs.count])
 
-        spring_vec = self._getSpringVector()
-        self.p1.applyForce((resistance + damping) * spring_vec)
-        self.p2.applyForce((resistance + damping) * -spring_vec)
+    @staticmethod
+    def renderEnds(screen, positions, i1, i2):
+        '''Draws the bonds between particles i1 and i2 like renderMany.'''
+        if not SpringBond.RENDER: return
+        drawSegments(screen, positions[i1], positions[i2], SpringBond.RENDER_COLOR, SpringBond.RENDER_THICKNESS)
 
     def render(self, screen):
         if not SpringBond.RENDER: return
-        draw.line(screen, SpringBond.RENDER_COLOR, 
-                  (self.p1.pos.x, self.p1.pos.y),
-                  (self.p2.pos.x, self.p2.pos.y),
+        draw.line(screen, SpringBond.RENDER_COLOR,
+                  self.p1.store.renderPosition(self.p1.index),
+                  self.p2.store.renderPosition(self.p2.index),
                   SpringBond.RENDER_THICKNESS)
-    
\ No newline at end of file
+
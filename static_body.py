@@ -1,7 +1,8 @@
 from dynamic_object import Updatable, Renderable
 from bounds import PolygonalBound
-from pygame import Vector2, draw
+from pygame import Vector2, draw, Surface, SRCALPHA
 from particle import Particle
+import numpy as np
 
 class StaticBody(Updatable, Renderable):
 
@@ -14,43 +15,110 @@ class StaticBody(Updatable, Renderable):
     RENDER_EDGES = True
     RENDER_FILL = True
 
+    CONTACT_SKIN = 0.05 # Pixels outside the edge that points crossing into the body are stopped at
+
     def __init__(self, shape: PolygonalBound):
         self.shape = shape
+        # The world whose particles collide with this body (see World.addStaticbodies)
+        self.world = None
+
+        # Determine the normal flipper (direction of normals) of each ring, per edge
+        self._normal_flippers = np.concatenate([np.full(len(ring), self._getNormalFlipper(ring))
+                                                for ring in self.shape.rings])
+        self._outward_normals = self.shape.edge_normals * self._normal_flippers[:, None]
 
-        # Determine normal flipper (direction of normals)
-        self._normal_flipper = -1
-        p1, p2 = self.shape.points[0], self.shape.points[1]
-        D = Vector2(p2[0] - p1[0], p2[1] - p1[1])
+    def __getstate__(self):
+        # Sent to worker processes without its world, which they have their own view of
+        return {**self.__dict__, 'world': None}
+
+    def _getNormalFlipper(self, ring) -> int:
+        '''Gets the sign that makes a ring's edge normals point out of the body.'''
+        for i in range(1, len(ring)):
+            p1, p2 = ring[i - 1], ring[i]
+            D = Vector2(p2[0] - p1[0], p2[1] - p1[1])
+            if D.length_squared() != 0:
+                break
         mid = Vector2(p1[0], p1[1]) + D / 2
         projection_point = mid + D.normalize().rotate(90)
         if self.shape.contains((projection_point.x, projection_point.y)):
-            self._normal_flipper = 1
+            return 1
+        return -1
 
     def containsParticle(self, particle: Particle) -> bool:
         return self.shape.contains((particle.pos.x, particle.pos.y))
 
     def update(self, dt):
-        for particle in Particle.particles:
-            # Ignore particle if it hasn't collided
-            if not self.containsParticle(particle):
-                continue
-            # Determine which edge was hit
-            hit_edge_points = self.shape.getClosestEdgeToPoint((particle.pos.x, particle.pos.y))
-            # Reflect off of colliding edge
-            l = Vector2(hit_edge_points[0][0] - hit_edge_points[1][0], hit_edge_points[0][1] - hit_edge_points[1][1])
-            N = l.rotate(90).normalize() * self._normal_flipper
-            # Push the particle out of the static body
-            particle.pos += 2 * particle.vel.magnitude() * N * dt
-            particle.vel = particle.vel.reflect(N)
+        '''Resolves the collisions of every live particle of its world with this body in
+        one batch, over the moves they made since their positions were last saved.'''
+        if self.world is None:
+            return
+        store, live = self.world.particles, self.world.live()
+        pos, vel = store.pos[live], store.vel[live]
+        self.collide(pos, vel, dt, store.prev_pos[live])
+        store.pos[live], store.vel[live] = pos, vel
+
+    def collide(self, pos: np.ndarray, vel: np.ndarray, dt, prev_pos: np.ndarray = None):
+        '''Pushes the points of an N×2 position array that are inside this body back out
+        and reflects their velocities, modifying both arrays in place. Given the
+        positions they moved from, points that crossed into the body on the way are
+        first stopped where they crossed, so that fast points and large steps do not
+        pass through thin parts of it.'''
+        if prev_pos is not None:
+            self._sweep(pos, vel, prev_pos)
+        hits, edge_indices, normals = self.shape.queryPoints(pos)
+        if not hits.any():
+            return
+        # Reflect off of colliding edges
+        N = normals[hits] * self._normal_flippers[edge_indices[hits], None]
+        hit_vel = vel[hits]
+        speeds = np.sqrt(np.einsum('ij,ij->i', hit_vel, hit_vel))
+        # Push the particles out of the static body
+        pos[hits] += 2 * speeds[:, None] * N * dt
+        vel[hits] = hit_vel - 2 * np.einsum('ij,ij->i', hit_vel, N)[:, None] * N
+
+    def _sweep(self, pos: np.ndarray, vel: np.ndarray, prev_pos: np.ndarray):
+        '''Moves points that crossed an edge into the body back to just outside where
+        they crossed, and reflects the part of their velocities going into it.'''
+        crossed, fractions, edge_indices = self.shape.sweepPoints(prev_pos, pos, self._outward_normals)
+        if not crossed.any():
+            return
+        N = self._outward_normals[edge_indices[crossed]]
+        starts = prev_pos[crossed]
+        pos[crossed] = starts + fractions[crossed, None] * (pos[crossed] - starts) + StaticBody.CONTACT_SKIN * N
+        hit_vel = vel[crossed]
+        inward_speeds = np.minimum(0, np.einsum('ij,ij->i', hit_vel, N))
+        vel[crossed] = hit_vel - 2 * inward_speeds[:, None] * N
+
+    @staticmethod
+    def renderSettings() -> tuple:
+        '''The current value of every RENDER_ setting, for telling when cached
+        renders are out of date.'''
+        return tuple(value for name, value in sorted(vars(StaticBody).items()) if name.startswith('RENDER_'))
 
     def render(self, screen):
         # Fill
         if StaticBody.RENDER_FILL:
-            draw.polygon(screen, StaticBody.RENDER_FILL_COLOR, self.shape.points)
+            if self.shape.holes:
+                self._renderFillWithHoles(screen)
+            else:
+                draw.polygon(screen, StaticBody.RENDER_FILL_COLOR, self.shape.points)
         # Draw edges
         if StaticBody.RENDER_EDGES:
-            draw.lines(screen, StaticBody.RENDER_EDGE_COLOR, True, self.shape.points, StaticBody.RENDER_EDGE_WIDTH)
+            for ring in self.shape.rings:
+                draw.lines(screen, StaticBody.RENDER_EDGE_COLOR, True, ring, StaticBody.RENDER_EDGE_WIDTH)
         # Draw verts
         if StaticBody.RENDER_VERTS:
-            for point in self.shape.points:
-                draw.circle(screen, StaticBody.RENDER_VERTEX_COLOR, point, StaticBody.RENDER_VERTEX_RADIUS)
\ No newline at end of file
+            for ring in self.shape.rings:
+                for point in ring:
+                    draw.circle(screen, StaticBody.RENDER_VERTEX_COLOR, point, StaticBody.RENDER_VERTEX_RADIUS)
+
+    def _renderFillWithHoles(self, screen):
+        '''Fills the outer ring on a transparent layer, cuts the holes back out of it
+        and blits the result.'''
+        bound = self.shape.rectangle_bound
+        layer = Surface((bound.width + 1, bound.height + 1), SRCALPHA)
+        offset = lambda ring: [(x - bound.x, y - bound.y) for x, y in ring]
+        draw.polygon(layer, StaticBody.RENDER_FILL_COLOR, offset(self.shape.points))
+        for hole in self.shape.holes:
+            draw.polygon(layer, (0, 0, 0, 0), offset(hole))
+        screen.blit(layer, (bound.x, bound.y))
\ No newline at end of file
@@ -0,0 +1,26 @@
+from static_body import StaticBody
+from pygame import Surface, SRCALPHA
+
+class StaticLayer:
+    '''Static bodies pre-rendered onto one transparent, screen-sized surface. Static
+    bodies never move, so the layer is only redrawn when the bodies, the screen size
+    or StaticBody's render settings change, and is otherwise a single blit.'''
+
+    def __init__(self):
+        self.surface = None
+        self._key = None
+
+    def invalidate(self):
+        self._key = None
+
+    def render(self, screen, staticbodies) -> bool:
+        '''Blits the layer, redrawing it first if it is out of date. Returns whether it
+        was redrawn.'''
+        key = (screen.get_size(), tuple(map(id, staticbodies)), StaticBody.renderSettings())
+        redrawn = key != self._key
+        if redrawn:
+            self.surface = Surface(screen.get_size(), SRCALPHA)
+            [staticbody.render(self.surface) for staticbody in staticbodies]
+            self._key = key
+        screen.blit(self.surface, (0, 0))
+        return redrawn
@@ -0,0 +1,77 @@
+import numpy as np
+from particle_array import ParticleArray
+from spring_array import SpringArray
+
+class World:
+    '''The particles, bonds and static bodies of one scene. Particles are spawned and
+    despawned in bulk; despawned rows go on a free list and are reused by later
+    spawns, and compact packs the live particles together once too many rows are
+    free. Everything that steps particles should only touch the live ones.'''
+
+    COMPACT_FRACTION = 0.5 # Fraction of free rows at which the world is worth compacting
+
+    def __init__(self):
+        self.particles = ParticleArray()
+        self.springs = SpringArray()
+        self.staticbodies = []
+        self.alive = np.zeros(0, dtype=bool)
+        self.free = np.zeros(0, dtype=int)
+
+    def spawn(self, positions, velocities, mass) -> np.ndarray:
+        '''Adds particles, reusing free rows before growing the store, and returns
+        their indices.'''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        velocities = np.asarray(velocities, dtype=float).reshape(-1, 2)
+        mass = np.broadcast_to(np.asarray(mass, dtype=float), len(positions))
+        reused = self.free[:len(positions)]
+        self.free = self.free[len(reused):]
+        self.particles.setMany(reused, positions[:len(reused)], velocities[:len(reused)], mass[:len(reused)])
+        added = self.particles.addMany(positions[len(reused):], velocities[len(reused):], mass[len(reused):])
+
+        if len(self.alive) < len(self.particles.mass):
+            alive = np.zeros(len(self.particles.mass), dtype=bool)
+            alive[:len(self.alive)] = self.alive
+            self.alive = alive
+        indices = np.concatenate([reused, added])
+        self.alive[indices] = True
+        return indices
+
+    def despawn(self, indices):
+        '''Removes particles, along with every bond attached to them.'''
+        indices = np.unique(np.asarray(indices, dtype=int))
+        indices = indices[self.alive[indices]]
+        if len(indices) == 0:
+            return
+        self.alive[indices] = False
+        self.particles.vel[indices] = 0
+        self.particles.force[indices] = 0
+        self.free = np.concatenate([self.free, indices])
+
+        springs = self.springs
+        i1, i2 = springs.i1[:springs.count], springs.i2[:springs.count]
+        springs.keep(np.flatnonzero(self.alive[i1] & self.alive[i2]))
+
+    def live(self) -> np.ndarray:
+        '''Indices of the live particles, in order.'''
+        return np.flatnonzero(self.alive[:self.particles.count])
+
+    def sparse(self) -> bool:
+        return len(self.free) > World.COMPACT_FRACTION * self.particles.count
+
+    def compact(self) -> np.ndarray:
+        '''Packs the live particles to the front of the store, keeping their order, and
+        renumbers the bonds. Returns the new index of every old row (-1 for free rows).'''
+        live = self.live()
+        remap = np.full(len(self.particles.mass), -1)
+        remap[live] = np.arange(len(live))
+        self.particles.keep(live)
+        self.springs.renumber(remap)
+        self.alive[:] = False
+        self.alive[:len(live)] = True
+        self.free = np.zeros(0, dtype=int)
+        return remap
+
+    def addStaticbodies(self, staticbodies: list):
+        for staticbody in staticbodies:
+            staticbody.world = self
+        self.staticbodies.extend(staticbodies)
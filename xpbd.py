@@ -0,0 +1,128 @@
+import numpy as np
+from particle_array import ParticleArray
+from spring_array import SpringArray
+
+def colorBonds(count: int, i1: np.ndarray, i2: np.ndarray) -> np.ndarray:
+    '''Colours the bonds between count particles so that no two bonds of a colour share
+    a particle, using few colours (at most 2 × the most bonds on one particle - 1).
+    Every round, each remaining bond asks for the lowest colour still free at both of
+    its ends, and where several ask for the same colour at a particle the one with
+    the lowest (fixed, shuffled) priority gets it. Returns the colour of every bond.'''
+    colors = np.full(len(i1), -1)
+    # Colours used at each particle, as bits of enough 64 bit words for every colour that can be needed
+    most_bonds = int(np.bincount(np.concatenate([i1, i2]), minlength=1).max()) if len(i1) > 0 else 0
+    words = max(1, -(-(2*most_bonds - 1) // 64))
+    used = np.zeros((count, words), dtype=np.uint64)
+    priorities = np.random.default_rng(0).permutation(len(i1))
+    remaining = np.arange(len(i1))
+    while len(remaining) > 0:
+        a, b = i1[remaining], i2[remaining]
+        free = ~(used[a] | used[b])
+        # Lowest free bit of the first word with one
+        word = np.argmax(free != 0, axis=1)
+        free = free[np.arange(len(remaining)), word]
+        bits = free & (~free + np.uint64(1))
+        wanted = word * 64 + np.log2(bits.astype(float)).astype(np.int64)
+
+        # A bond wins if it has the lowest priority for its colour at both of its ends
+        keys = np.concatenate([a, b]) * (64*words) + np.tile(wanted, 2)
+        order = np.lexsort((np.tile(priorities[remaining], 2), keys))
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[order][1:] != keys[order][:-1]
+        wins = np.zeros(len(keys), dtype=bool)
+        wins[order] = first
+        won = wins[:len(remaining)] & wins[len(remaining):]
+
+        colors[remaining[won]] = wanted[won]
+        np.bitwise_or.at(used, (a[won], word[won]), bits[won])
+        np.bitwise_or.at(used, (b[won], word[won]), bits[won])
+        remaining = remaining[~won]
+    return colors
+
+
+class XPBDSolver:
+    '''Extended position based dynamics: each bond is a distance constraint with a
+    compliance of 1/k, so that the stiffness of the force based springs carries over.
+
+    A step predicts the positions from the velocities, projects the constraints
+    ITERATIONS times and takes the velocities from how far the particles moved.
+    Bonds of one colour (see colorBonds) share no particles, so a colour is projected
+    in one batch, and colours in turn, which is the same as projecting the bonds one
+    at a time. Stiff bodies stay stable at large steps, where the force based springs
+    blow up.'''
+
+    ITERATIONS = 8
+
+    def __init__(self, iterations=ITERATIONS, damping=SpringArray.DAMPING):
+        self.iterations = iterations
+        self.damping = damping
+        self._colors = np.zeros(0, dtype=int)
+        self._colored_springs = None
+        self._colored_version = -1
+
+    def _bondColors(self, particles: ParticleArray, springs: SpringArray) -> np.ndarray:
+        # Colours only depend on which particles bonds join, so they are kept until bonds are added, removed or renumbered
+        if self._colored_springs is not springs or self._colored_version != springs.topology_version:
+            self._colors = colorBonds(particles.count, springs.i1[:springs.count], springs.i2[:springs.count])
+            self._colored_springs = springs
+            self._colored_version = springs.topology_version
+        return self._colors
+
+    def step(self, particles: ParticleArray, springs: SpringArray, dt, indices=None, bond_indices=None):
+        '''Steps the given particles (all by default) under their accumulated forces and
+        the given bonds (all by default), and resets their net force. Bonds should only
+        join stepped particles.'''
+        indices = particles._indices(indices)
+        bond_indices = np.arange(springs.count) if bond_indices is None else np.asarray(bond_indices, dtype=int)
+        # Bonds without stiffness have infinite compliance and do nothing
+        bond_indices = bond_indices[springs.k[bond_indices] > 0]
+        pos, vel = particles.pos, particles.vel
+        inverse_mass = np.zeros(len(particles.mass))
+        inverse_mass[indices] = 1 / particles.mass[indices]
+
+        # Predict
+        particles.savePositions()
+        particles.accel[indices] = particles.force[indices] * inverse_mass[indices, None]
+        vel[indices] += particles.accel[indices] * dt
+        pos[indices] += vel[indices] * dt
+        particles.force[indices] = 0
+
+        # Project, colour by colour
+        colors = self._bondColors(particles, springs)[bond_indices]
+        order = np.argsort(colors, kind='stable')
+        groups = np.split(bond_indices[order], np.flatnonzero(np.diff(colors[order])) + 1)
+        groups = [(springs.i1[group], springs.i2[group], springs.rest_length[group],
+                   1 / (springs.k[group] * dt**2), np.zeros(len(group))) for group in groups if len(group) > 0]
+        for _ in range(self.iterations):
+            for i1, i2, rest_length, compliance, multipliers in groups:
+                w1, w2 = inverse_mass[i1], inverse_mass[i2]
+                offsets = pos[i2] - pos[i1]
+                lengths = np.sqrt(np.einsum('ij,ij->i', offsets, offsets))
+                # Bonds with zero length have no direction and are skipped
+                stretched = lengths != 0
+                normals = np.zeros_like(offsets)
+                normals[stretched] = offsets[stretched] / lengths[stretched, None]
+                delta = np.where(stretched, -(lengths - rest_length) - compliance * multipliers, 0) / (w1 + w2 + compliance)
+                multipliers += delta
+                pos[i1] -= (w1 * delta)[:, None] * normals
+                pos[i2] += (w2 * delta)[:, None] * normals
+
+        vel[indices] = (pos[indices] - particles.prev_pos[indices]) / dt
+        if self.damping != 0:
+            for i1, i2, _, _, _ in groups:
+                self._damp(particles, inverse_mass, i1, i2, dt)
+
+    def _damp(self, particles: ParticleArray, inverse_mass, i1, i2, dt):
+        '''Applies the damping of the force based springs (force = damping × relative
+        velocity along the bond) to bonds that share no particles, as an impulse capped
+        so that it never reverses the relative velocity.'''
+        offsets = particles.pos[i2] - particles.pos[i1]
+        lengths = np.sqrt(np.einsum('ij,ij->i', offsets, offsets))
+        stretched = lengths != 0
+        normals = np.zeros_like(offsets)
+        normals[stretched] = offsets[stretched] / lengths[stretched, None]
+        relative_speeds = np.einsum('ij,ij->i', normals, particles.vel[i2] - particles.vel[i1])
+        w1, w2 = inverse_mass[i1], inverse_mass[i2]
+        impulses = relative_speeds * np.minimum(1, self.damping * (w1 + w2) * dt) / (w1 + w2)
+        particles.vel[i1] += (w1 * impulses)[:, None] * normals
+        particles.vel[i2] -= (w2 * impulses)[:, None] * normals